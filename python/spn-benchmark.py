@@ -0,0 +1,483 @@
+import os
+import sys
+import json
+import random
+import timeit
+import itertools
+import platform
+import argparse
+import statistics
+import importlib.util
+
+"""
+Microbenchmarks for the cipher primitives and the attack kernels of
+spn-diff-crypt.py and toy-cipher-diff-crypt.py.
+
+Every benchmark is set up from a fixed seed, warmed up, and then timed a
+number of times. Reference functions are benchmarked next to their faster
+counterparts (e.g. encrypt next to fast_encrypt and encrypt_batch) so that
+they can be compared directly. Use --json to save the results and compare
+them between runs. """
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Every benchmark function is registered here by the benchmark decorator
+BENCHMARKS = []
+
+def main():
+    args = parse_arguments()
+
+    spn = load_script('spn-diff-crypt.py', 'spn_diff_crypt')
+    toy = load_script('toy-cipher-diff-crypt.py', 'toy_cipher_diff_crypt')
+
+    spn.compile_cipher()
+
+    if not spn.check_compiled_cipher():
+        sys.exit('Error: compiled cipher does not match the reference implementation')
+
+    benchmarks = [b for b in BENCHMARKS if args.filter is None or any(f in b[0] for f in args.filter)]
+
+    if args.list:
+        for name, setup in benchmarks:
+            print(name)
+
+        return
+
+    results = []
+
+    # Every time is per operation
+    print(f'{"benchmark":<44} {"min":>10} {"median":>10} (+- stdev)')
+
+    for name, setup in benchmarks:
+        # Seed everything the benchmark could touch, so every run (and every
+        # implementation) works on the same inputs
+        random.seed(args.seed)
+
+        if spn.np is not None:
+            spn.np.random.seed(args.seed)
+
+        function, num_operations = setup(spn, toy, random.Random(args.seed))
+
+        # None means the benchmark needs something which isn't available
+        # here, like NumPy
+        if function is None: continue
+
+        result = run_benchmark(name, function, num_operations, args.warmup, args.repeats, args.min_time)
+        results.append(result)
+
+        print(get_result_string(result), flush=True)
+
+    if args.json is not None:
+        write_results(args.json, args, spn, results)
+
+
+
+""" --- TIMING --- """
+
+def run_benchmark(name, function, num_operations, warmup, repeats, min_time):
+    """
+    Times function, which does num_operations operations per call.
+
+    The number of calls per repeat is chosen so that a repeat takes at least
+    min_time seconds. Returns the seconds per operation of every repeat
+    together with their statistics.
+    """
+
+    timer = timeit.Timer(function)
+
+    # Warm up caches (and find out how long a call takes)
+    for i in range(warmup):
+        function()
+
+    number = 1
+
+    while True:
+        if timer.timeit(number) >= min_time: break
+
+        number *= 2
+
+    times = [t / (number * num_operations) for t in timer.repeat(repeats, number)]
+
+    return {
+        'name': name,
+        'operations_per_call': num_operations,
+        'calls_per_repeat': number,
+        'repeats': repeats,
+        'seconds_per_operation': {
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        },
+        'times': times,
+    }
+
+def get_result_string(result):
+    seconds = result['seconds_per_operation']
+
+    return f'{result["name"]:<44} {format_seconds(seconds["min"]):>10} {format_seconds(seconds["median"]):>10} ' \
+           f'(+- {format_seconds(seconds["stdev"])})'
+
+def format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+
+    return f'{seconds / 1e-9:.1f} ns'
+
+def write_results(path, args, spn, results):
+    """
+    Writes the results as JSON to path, or to standard output if path is
+    '-'.
+    """
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'numpy': None if spn.np is None else spn.np.__version__,
+        'seed': args.seed,
+        'warmup': args.warmup,
+        'min_time': args.min_time,
+        'results': results,
+    }
+
+    report = json.dumps(report, indent=2)
+
+    if path == '-':
+        print('\n' + report)
+
+        return
+
+    with open(path, 'w') as f:
+        f.write(report + '\n')
+
+
+
+""" --- BENCHMARKS --- """
+
+# Each benchmark gets both loaded scripts and a seeded random.Random and
+# returns (function, num_operations): a function without arguments to time
+# and how many operations one call does. It returns (None, 0) if it can't
+# run here
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+
+        return setup
+
+    return register
+
+def get_round_keys(spn):
+    return [spn.KEY1, spn.KEY2, spn.KEY3, spn.KEY4, spn.KEY5]
+
+def get_random_states(rng, num):
+    return [rng.getrandbits(16) for i in range(num)]
+
+@benchmark('spn.substitute')
+def benchmark_substitute(spn, toy, rng):
+    states = get_random_states(rng, 1000)
+
+    def run():
+        for state in states:
+            spn.substitute(state, spn.SBOX)
+
+    return (run, len(states))
+
+@benchmark('spn.permutate')
+def benchmark_permutate(spn, toy, rng):
+    states = get_random_states(rng, 1000)
+
+    def run():
+        for state in states:
+            spn.permutate(state, spn.PBOX)
+
+    return (run, len(states))
+
+@benchmark('spn.encrypt')
+def benchmark_encrypt(spn, toy, rng):
+    states = get_random_states(rng, 1000)
+    keys = get_round_keys(spn)
+
+    def run():
+        for state in states:
+            spn.encrypt(state, *keys)
+
+    return (run, len(states))
+
+@benchmark('spn.fast_encrypt')
+def benchmark_fast_encrypt(spn, toy, rng):
+    states = get_random_states(rng, 1000)
+    keys = get_round_keys(spn)
+
+    def run():
+        for state in states:
+            spn.fast_encrypt(state, *keys)
+
+    return (run, len(states))
+
+@benchmark('spn.encrypt_batch')
+def benchmark_encrypt_batch(spn, toy, rng):
+    if spn.np is None: return (None, 0)
+
+    states = spn.np.array(get_random_states(rng, 0x10000), dtype=spn.np.uint16)
+    keys = get_round_keys(spn)
+
+    return (lambda: spn.encrypt_batch(states, *keys), len(states))
+
+@benchmark('spn.encrypt_bitsliced')
+def benchmark_encrypt_bitsliced(spn, toy, rng):
+    states = get_random_states(rng, 0x10000)
+    keys = get_round_keys(spn)
+
+    if spn.np is not None:
+        states = spn.np.array(states, dtype=spn.np.uint16)
+
+    return (lambda: spn.encrypt_bitsliced(states, *keys), len(states))
+
+@benchmark('spn.decrypt')
+def benchmark_decrypt(spn, toy, rng):
+    states = get_random_states(rng, 1000)
+    keys = get_round_keys(spn)
+
+    def run():
+        for state in states:
+            spn.decrypt(state, *keys)
+
+    return (run, len(states))
+
+@benchmark('spn.fast_decrypt')
+def benchmark_fast_decrypt(spn, toy, rng):
+    states = get_random_states(rng, 1000)
+    keys = get_round_keys(spn)
+
+    def run():
+        for state in states:
+            spn.fast_decrypt(state, *keys)
+
+    return (run, len(states))
+
+@benchmark('spn.decrypt_batch')
+def benchmark_decrypt_batch(spn, toy, rng):
+    if spn.np is None: return (None, 0)
+
+    states = spn.np.array(get_random_states(rng, 0x10000), dtype=spn.np.uint16)
+    keys = get_round_keys(spn)
+
+    return (lambda: spn.decrypt_batch(states, *keys), len(states))
+
+@benchmark('spn.partial_decryption')
+def benchmark_partial_decryption(spn, toy, rng):
+    pairs = list(zip(get_random_states(rng, 1000), get_random_states(rng, 1000)))
+    keys = get_round_keys(spn)
+
+    def run():
+        for round_num in range(4):
+            for ciphertext1, ciphertext2 in pairs:
+                spn.partial_decryption(round_num, ciphertext1, ciphertext2, keys)
+
+    return (run, 4 * len(pairs))
+
+@benchmark('spn.fast_partial_decryption')
+def benchmark_fast_partial_decryption(spn, toy, rng):
+    pairs = list(zip(get_random_states(rng, 1000), get_random_states(rng, 1000)))
+    keys = get_round_keys(spn)
+
+    def run():
+        for round_num in range(4):
+            for ciphertext1, ciphertext2 in pairs:
+                spn.fast_partial_decryption(round_num, ciphertext1, ciphertext2, keys)
+
+    return (run, 4 * len(pairs))
+
+@benchmark('spn.build_difference_distribution_table')
+def benchmark_build_difference_distribution_table(spn, toy, rng):
+    return (lambda: spn.build_difference_distribution_table(spn.SBOX), 1)
+
+@benchmark('spn.find_differential_trail')
+def benchmark_find_differential_trail(spn, toy, rng):
+    diff_dist_table = spn.build_difference_distribution_table(spn.SBOX)
+    input_xors = [rng.randint(1, 0xffff) for i in range(100)]
+
+    def run():
+        for input_xor in input_xors:
+            spn.find_differential_trail(input_xor, diff_dist_table, 3)
+
+    return (run, len(input_xors))
+
+@benchmark('spn.find_optimal_differential_trail')
+def benchmark_find_optimal_differential_trail(spn, toy, rng):
+    diff_dist_table = spn.build_difference_distribution_table(spn.SBOX)
+    best_probabilities = spn.find_optimal_trail_probabilities(diff_dist_table, 2)
+
+    # One search per combination of final active SBOXes, like
+    # find_optimal_differential_trails does. Two rounds, because the three
+    # round searches take seconds
+    all_final_active_sboxes = [[s & (1 << i) != 0 for i in range(4)] for s in range(1, 16)]
+
+    def run():
+        for final_active_sboxes in all_final_active_sboxes:
+            spn.find_optimal_differential_trail(diff_dist_table, 2, final_active_sboxes, best_probabilities)
+
+    return (run, len(all_final_active_sboxes))
+
+@benchmark('spn.guess_key_bits')
+def benchmark_guess_key_bits(spn, toy, rng):
+    round_keys, pairs, output_xor, breaking_key_bits = get_key_guessing_input(spn, rng, 100)
+
+    def run():
+        key_counts = [0] * (1 << spn.count_one_bits(breaking_key_bits))
+
+        for ciphertext1, ciphertext2 in pairs:
+            spn.guess_key_bits(3, ciphertext1, ciphertext2, output_xor, key_counts, breaking_key_bits)
+
+    return (run, len(pairs))
+
+@benchmark('spn.count_key_guesses')
+def benchmark_count_key_guesses(spn, toy, rng):
+    if spn.np is None: return (None, 0)
+
+    round_keys, pairs, output_xor, breaking_key_bits = get_key_guessing_input(spn, rng, 10000)
+
+    ciphertexts1 = spn.np.array([p[0] for p in pairs], dtype=spn.np.uint16)
+    ciphertexts2 = spn.np.array([p[1] for p in pairs], dtype=spn.np.uint16)
+
+    weights = spn.np.ones(len(pairs), dtype=spn.np.int64)
+
+    return (lambda: spn.count_key_guesses(3, ciphertexts1, ciphertexts2, weights, output_xor, breaking_key_bits), len(pairs))
+
+@benchmark('spn.count_key_bits')
+def benchmark_count_key_bits(spn, toy, rng):
+    if spn.np is None: return (None, 0)
+
+    # Filtering, compressing into a histogram and counting, with many more
+    # pairs than there are histogram bins
+    round_keys, pairs, output_xor, breaking_key_bits = get_key_guessing_input(spn, rng, 200000)
+
+    ciphertexts1 = spn.np.array([p[0] for p in pairs], dtype=spn.np.uint16)
+    ciphertexts2 = spn.np.array([p[1] for p in pairs], dtype=spn.np.uint16)
+
+    return (lambda: spn.count_key_bits(3, ciphertexts1, ciphertexts2, output_xor, breaking_key_bits, round_keys), len(pairs))
+
+def get_key_guessing_input(spn, rng, num_pairs):
+    """
+    Returns the input for guessing the bits of KEY5 under two active SBOXes
+    (256 key guesses per pair), with pairs which all pass the right pair
+    filter so that none of them are skipped early. There are no known
+    rounds after KEY5, so the ciphertexts are also the partially decrypted
+    states guess_key_bits and count_key_guesses take.
+    """
+
+    round_keys = get_round_keys(spn)
+    output_xor = 0x0606
+    breaking_key_bits = spn.find_which_key_bits_will_be_broken(3, output_xor)
+
+    pairs = []
+
+    while len(pairs) < num_pairs:
+        ciphertext1 = rng.getrandbits(16)
+        ciphertext2 = ciphertext1 ^ (rng.getrandbits(16) & breaking_key_bits)
+
+        if ciphertext1 != ciphertext2:
+            pairs.append((ciphertext1, ciphertext2))
+
+    return (round_keys, pairs, output_xor, breaking_key_bits)
+
+def get_partial_keys_to_combine(rng):
+    # Four nibble-sized partial keys with 8 candidates each, like breaking a
+    # round key with four single SBOX trails and MIN_OPTIONS = 8
+    return [rng.sample([k << (4 * i) for k in range(16)], 8) for i in range(4)]
+
+@benchmark('spn.combine_partial_keys')
+def benchmark_combine_partial_keys(spn, toy, rng):
+    partial_keys_to_combine = get_partial_keys_to_combine(rng)
+
+    # All 8^4 full keys
+    return (lambda: list(spn.combine_partial_keys(partial_keys_to_combine)), 1)
+
+@benchmark('spn.combine_partial_keys (first 10)')
+def benchmark_combine_partial_keys_first_10(spn, toy, rng):
+    partial_keys_to_combine = get_partial_keys_to_combine(rng)
+
+    # The attack usually only gets to the first few full keys
+    return (lambda: list(itertools.islice(spn.combine_partial_keys(partial_keys_to_combine), 10)), 1)
+
+@benchmark('toy.get_good_pair')
+def benchmark_toy_get_good_pair(spn, toy, rng):
+    diff_chars = [(input_xor, output_xor) for input_xor in range(1, 16) for output_xor in range(1, 16)]
+
+    def run():
+        for diff_char in diff_chars:
+            toy.get_good_pair(diff_char)
+
+    return (run, len(diff_chars))
+
+@benchmark('toy.get_possible_key_pairs')
+def benchmark_toy_get_possible_key_pairs(spn, toy, rng):
+    diff_dist_table = toy.build_difference_distribution_table(toy.SBOX)
+
+    diff_chars = [(input_xor, output_xor) for input_xor in range(1, 16) for output_xor in range(1, 16)]
+    good_pairs = [toy.get_good_pair(diff_char) for diff_char in diff_chars]
+    good_pairs = [good_pair for good_pair in good_pairs if good_pair is not None]
+
+    def run():
+        for good_pair in good_pairs:
+            toy.get_possible_key_pairs(good_pair, diff_dist_table)
+
+    return (run, len(good_pairs))
+
+
+
+""" --- MISC FUNCTIONS --- """
+
+def load_script(file_name, module_name):
+    """
+    The scripts have dashes in their names, so they can't simply be
+    imported. Loads file_name from this directory as module_name.
+    """
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+
+    # Registered before running it, so that worker processes can find it
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the SPN and toy cipher scripts.')
+
+    parser.add_argument('filter', nargs='*', default=None,
+                        help='only run the benchmarks whose names contain one of these strings')
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks instead of running them')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the benchmark inputs (default: 0)')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='number of untimed calls before timing (default: 1)')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='number of timed repeats (default: 5)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per repeat, more calls are made per repeat until it is reached (default: 0.2)')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results as JSON to PATH (- for standard output)')
+
+    args = parser.parse_args()
+
+    if len(args.filter) == 0:
+        args.filter = None
+
+    if args.repeats < 1:
+        parser.error('--repeats should be at least 1')
+
+    if args.warmup < 0:
+        parser.error('--warmup should not be negative')
+
+    return args
+
+
+
+if __name__=="__main__":
+    main()
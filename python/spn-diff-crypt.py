@@ -1,7 +1,31 @@
+import os
 import sys
+import struct
+import hashlib
+import heapq
+import itertools
+import argparse
 import random
 import time
 import math
+import json
+import asyncio
+import threading
+import contextlib
+import concurrent.futures
+
+# Only used to report the peak memory of the attack. Not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# NumPy is optional. Without it the attack falls back to encrypting one
+# plaintext at a time with the compiled cipher
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 This script was written for the Differential Cryptanalysis Tutorial.
@@ -36,10 +60,196 @@ MIN_OPTIONS = 3
 INV_SBOX = [SBOX.index(i) if i in SBOX else i for i in range(len(SBOX))]
 INV_PBOX = [PBOX.index(i) if i in PBOX else i for i in range(len(PBOX))]
 
+# Full state lookup tables used by the compiled cipher. They are filled in by
+# compile_cipher() once the SBOX and PBOX have been validated
+SUB_TABLE = None
+INV_SUB_TABLE = None
+ROUND_TABLE = None
+INV_ROUND_TABLE = None
+INV_PERM_TABLE = None
+
+# NumPy copies of the tables above used by the batched cipher
+SUB_ARRAY = None
+INV_SUB_ARRAY = None
+ROUND_ARRAY = None
+INV_ROUND_ARRAY = None
+PERM_ARRAY = None
+INV_PERM_ARRAY = None
+
+# INV_SBOX_DIFF_ARRAY[u1][u2][g] = INV_SBOX[u1 ^ g] ^ INV_SBOX[u2 ^ g], the
+# XOR of two nibbles decrypted through one SBOX under the key nibble g
+INV_SBOX_DIFF_ARRAY = None
+
+# The predicted cost of a trail is QUERY_COST for every oracle query plus
+# KEY_GUESS_COST for every key guess counted for a pair. Trails are chosen to
+# break each round key at the lowest total cost, see get_trail_cost. Oracle
+# queries are what the attack is really limited by, while key guesses are
+# counted thousands at a time. Without NumPy, a key guess is a few hundred
+# times slower, and trails with many key guesses take far longer than the
+# queries they save would
+QUERY_COST = 1
+KEY_GUESS_COST = 1 / 1024 if np is not None else 1 / 16
+
+# Index arrays used by count_key_guesses, see get_key_guess_order
+KEY_GUESS_ORDERS = {}
+
+# Every key guess for a mask of key bits, see get_key_guesses
+KEY_GUESS_TABLES = {}
+
+# The whole codebook (and its inverse) when the oracle runs in codebook
+# mode. Filled in by build_codebook()
+CODEBOOK = None
+INV_CODEBOOK = None
+
+# How the oracle encrypts when there is no codebook: 'table' uses the
+# compiled cipher, 'bitsliced' the bitsliced cipher
+ORACLE_BACKEND = 'table'
+
+# The oracle answering the attack's queries, see get_oracle. Either a
+# LocalOracle (in this process) or a SocketOracle (a separate process)
+ORACLE = None
+
+# Every query sent to the oracle is recorded so that the cost of the attack
+# can be reported honestly, even when the answers come from the codebook
+ORACLE_QUERIES = {'encrypt': 0, 'decrypt': 0}
+ORACLE_SEEN = {'encrypt': bytearray(0x10000), 'decrypt': bytearray(0x10000)}
+
+# Pairs which can't be right pairs are filtered out before guessing keys.
+# With DDT_FILTER, pairs whose XORs are impossible according to the
+# difference distribution table are filtered out as well
+DDT_FILTER = False
+PAIR_FILTER_STATS = {'pairs': 0, 'survived': 0}
+
+# The XORs every SBOX can output for the input XORs of an output_xor, see
+# get_possible_xors
+POSSIBLE_XORS = {}
+
+# Plaintext structures collected so far when running with --structures,
+# see get_structure_pairs. The stats compare the oracle queries they needed
+# to the queries per-trail sampling would have needed, which chooses
+# PER_TRAIL_PAIRS[input_xor] pairs for every trail
+STRUCTURES = []
+STRUCTURE_STATS = {'queries': 0, 'per_trail_queries': 0}
+PER_TRAIL_PAIRS = {}
+
+# The chosen pairs of every trail, by input XOR, see get_chosen_pairs. They
+# are chosen once and reused whenever a round key is broken again under a
+# different hypothesis for the round keys after it. Only the first
+# MAX_CACHED_PAIRS pairs of every trail are kept, pairs beyond that are
+# chosen again every time
+CHOSEN_PAIRS = {}
+MAX_CACHED_PAIRS = 1 << 20
+
+# break_key_bits streams its pairs: they are chosen, encrypted, filtered and
+# counted PAIR_CHUNK_SIZE at a time, so memory doesn't grow with the number
+# of pairs. With SHOW_PROGRESS (--progress), trails which need more than one
+# chunk report their progress on standard error
+PAIR_CHUNK_SIZE = 1 << 16
+SHOW_PROGRESS = False
+
+# The partial key candidates found by break_round_key for every round key
+# hypothesis it was run under, see break_round_key
+ROUND_KEY_CACHE = {}
+
+# Known (plaintext, ciphertext) pairs which full key guesses are confirmed
+# against, see get_known_pairs. They're fetched from the oracle once, so
+# trying key guesses never asks the oracle anything. The guesses for KEY2
+# are tried CONFIRMATION_BATCH_SIZE at a time
+KNOWN_PAIRS = []
+NUM_KNOWN_PAIRS = 5
+CONFIRMATION_BATCH_SIZE = 64
+
+# With adaptive sampling (--adaptive), the trails of a round key choose
+# their pairs in steps, and every trail stops as soon as none of the key
+# guesses it throws away can be the right one (see keys_are_separated).
+# ADAPTIVE_ERROR_BOUND bounds the probability of throwing away the right key
+# guess over all steps of a trail together. ADAPTIVE_ROUND_TRIPS counts the
+# oracle round trips of every round key, see break_trails_adaptively
+ADAPTIVE_ERROR_BOUND = None
+ADAPTIVE_ROUND_TRIPS = {}
+ADAPTIVE_STATS = {'pairs': 0, 'max_pairs': 0}
+
+# Process pool used to count key guesses in parallel, with --workers greater
+# than 1. Sending pairs to the workers costs more than counting them unless
+# there are at least PARALLEL_MIN_KEY_GUESSES key guesses (histogram bins
+# times 2^bits) to count, so smaller counts stay in this process and the pool
+# is only started by the first count that big. Without NumPy, every key
+# guess is a few hundred times slower, so it pays off much sooner
+WORKER_POOL = None
+NUM_WORKERS = 1
+PARALLEL_MIN_KEY_GUESSES = 1 << 22 if np is not None else 1 << 14
+
+# Instrumentation for the --report JSON report. STAGE_TIMES maps each stage
+# of the attack to how often it ran and how long it took in total. See
+# record_key_guess_stats and partially_decrypt_known_rounds for what the
+# counters count
+STAGE_TIMES = {}
+ATTACK_STATS = {'pairs_processed': 0, 'pairs_counted': 0, 'histogram_bins': 0, 'key_guesses': 0, 'partial_decryptions': 0,
+                'round_keys_broken': 0, 'round_key_cache_hits': 0, 'confirmations': 0}
+
 def main():
+    args = parse_arguments()
+
+    attack_start = time.perf_counter()
+
+    # With the report on standard output, everything else is printed to
+    # standard error, so that standard output is only the JSON report
+    with contextlib.redirect_stdout(sys.stderr) if args.report == '-' else contextlib.nullcontext():
+        round_keys = run_attack(args)
+
+    if args.report is not None and args.serve_oracle is None:
+        write_report(args.report, args, round_keys, time.perf_counter() - attack_start)
+
+def run_attack(args):
+    """
+    Runs the attack (or the oracle server) as set up by the command line
+    arguments. Returns the round keys, or None if they weren't found.
+    """
+
     validate_input()
 
-    diff_dist_table = build_difference_distribution_table(SBOX)
+    compile_cipher()
+
+    if not check_compiled_cipher():
+        sys.exit('Error: compiled cipher does not match the reference implementation')
+
+    if args.oracle_backend == 'bitsliced':
+        use_bitsliced_oracle()
+
+    if args.codebook:
+        build_codebook()
+
+    if args.serve_oracle is not None:
+        serve_oracle(args.serve_oracle)
+
+        return None
+
+    if args.oracle is not None:
+        oracle = SocketOracle(args.oracle)
+
+        try:
+            oracle.connect()
+        except OSError as e:
+            sys.exit(f'Error: could not connect to the oracle server at {args.oracle} ({e})')
+
+        use_oracle(oracle)
+
+    if args.workers > 1:
+        use_worker_pool(args.workers)
+
+    if args.ddt_filter:
+        use_ddt_filter()
+
+    if args.adaptive:
+        use_adaptive_sampling(args.error_bound)
+
+    use_pair_streaming(args.chunk_size, args.progress)
+
+    use_structures = args.structures
+
+    with time_stage('difference distribution table'):
+        diff_dist_table = build_difference_distribution_table(SBOX)
+
     diff_dist_table_string = get_diff_dist_table_string(diff_dist_table)
 
     print('\nDifference distribution table:')
@@ -47,18 +257,27 @@ def main():
 
     print('\nFinding most probable differential trails for all rounds... ', end='', flush=True)
     # Get differential trails for all rounds
-    most_probable_diff_trails_3 = find_highly_probable_differential_trails(diff_dist_table, 3)
-    most_probable_diff_trails_2 = find_highly_probable_differential_trails(diff_dist_table, 2)
-    most_probable_diff_trails_1 = find_highly_probable_differential_trails(diff_dist_table, 1)
-    most_probable_diff_trails_0 = find_highly_probable_differential_trails(diff_dist_table, 0)
+    most_probable_diff_trails = get_differential_trails(diff_dist_table, args.trail_search, args.cache_dir)
+
+    most_probable_diff_trails_0, most_probable_diff_trails_1, most_probable_diff_trails_2, most_probable_diff_trails_3 = most_probable_diff_trails
     print('FOUND')
 
     print('\nFinding good combinations of differential trails which will break each round key...')
     # Find good combinations of diff trails which will break each full round key
-    useful_diff_trails_3 = find_differential_trails_to_break_full_key(3, most_probable_diff_trails_3)
-    useful_diff_trails_2 = find_differential_trails_to_break_full_key(2, most_probable_diff_trails_2)
-    useful_diff_trails_1 = find_differential_trails_to_break_full_key(1, most_probable_diff_trails_1)
-    useful_diff_trails_0 = find_differential_trails_to_break_full_key(0, most_probable_diff_trails_0)
+    with time_stage('trail selection'):
+        useful_diff_trails_3 = find_differential_trails_to_break_full_key(3, most_probable_diff_trails_3)
+        useful_diff_trails_2 = find_differential_trails_to_break_full_key(2, most_probable_diff_trails_2)
+        useful_diff_trails_1 = find_differential_trails_to_break_full_key(1, most_probable_diff_trails_1)
+        useful_diff_trails_0 = find_differential_trails_to_break_full_key(0, most_probable_diff_trails_0)
+
+    if args.exact_probabilities:
+        # Only the number of chosen plaintexts depends on this, so there's no
+        # need to compute it for the whole trail table
+        with time_stage('exact probabilities'):
+            useful_diff_trails_3 = use_differential_probabilities(diff_dist_table, 3, useful_diff_trails_3)
+            useful_diff_trails_2 = use_differential_probabilities(diff_dist_table, 2, useful_diff_trails_2)
+            useful_diff_trails_1 = use_differential_probabilities(diff_dist_table, 1, useful_diff_trails_1)
+            useful_diff_trails_0 = use_differential_probabilities(diff_dist_table, 0, useful_diff_trails_0)
 
     print(f'\n--- KEY5 Trails ---')
     for dt in useful_diff_trails_3: print(f'{format(dt[2], "#06x")} -> {format(dt[3], "#06x")} (probability {dt[1]})')
@@ -69,16 +288,61 @@ def main():
     print(f'\n--- KEY2 Trails ---')
     for dt in useful_diff_trails_0: print(f'{format(dt[2], "#06x")} -> {format(dt[3], "#06x")} (probability {dt[1]})')
 
+    start = time.time()
+
+    round_keys = break_all_round_keys(useful_diff_trails_3, useful_diff_trails_2, useful_diff_trails_1, useful_diff_trails_0, use_structures)
+
+    if args.oracle is not None:
+        get_oracle().close()
+
+    if round_keys is None:
+        print('\nCould not find the correct round keys')
+
+        return None
+
+    end = time.time()
+
+    print('\nFound correct round keys in ' + str(round(end - start, 2)) + ' seconds!') 
+
+    print('*****************')
+    for i in range(len(round_keys)):
+        print('  KEY' + str(i + 1) + ' = ' + format(round_keys[i], '#06x'))
+    print('*****************')
+
+    print('\n' + get_oracle_queries_string())
+    print('\n' + get_pair_filter_stats_string())
+
+    if use_structures:
+        print('\n' + get_structure_stats_string())
+
+    if args.adaptive:
+        print('\n' + get_adaptive_stats_string())
+
+    return round_keys
+
+
+
+""" --- DIFFERENTIAL CRYPTANALYSIS --- """
+
+def break_all_round_keys(useful_diff_trails_3, useful_diff_trails_2, useful_diff_trails_1, useful_diff_trails_0, use_structures=False):
+    """
+    Breaks all five round keys with the given trails for each round key,
+    backtracking whenever a combination of round key candidates fails to
+    confirm. Returns the round keys, or None if no combination of the
+    candidates is correct.
+    """
+
     # We'll be building up this arrray of round keys
     round_keys = [0, 0, 0, 0, 0]
 
-    start = time.time()
-
     print('\n----------------------------')
     print('\nBreaking KEY5...')
 
-    fifth_round_key_possibilities = break_round_key(3, useful_diff_trails_3, round_keys)
-    print('KEY5 possibilities = ' + get_hex_array(fifth_round_key_possibilities))
+    # The possibilities are generated lazily, most probable first, so only
+    # the ones we get to are ever built
+    fifth_round_key_possibilities = break_round_key(3, useful_diff_trails_3, round_keys, use_structures)
+    fifth_round_key_possibilities, possibilities_string = peek_round_key_possibilities(fifth_round_key_possibilities)
+    print('KEY5 possibilities = ' + possibilities_string)
 
     for k5 in fifth_round_key_possibilities:
         round_keys[4] = k5
@@ -86,81 +350,150 @@ def main():
         print('\nTesting with KEY5 = ' + format(k5, '#06x'))
 
         print('\n\tBreaking KEY4...')
-        fourth_round_key_possibilities = break_round_key(2, useful_diff_trails_2, round_keys)
-        print('\tKEY4 possibilities = ' + get_hex_array(fourth_round_key_possibilities))
+        fourth_round_key_possibilities = break_round_key(2, useful_diff_trails_2, round_keys, use_structures)
+        fourth_round_key_possibilities, possibilities_string = peek_round_key_possibilities(fourth_round_key_possibilities)
+        print('\tKEY4 possibilities = ' + possibilities_string)
 
         for k4 in fourth_round_key_possibilities:
             round_keys[3] = k4
 
             print('\tTesting with KEY4 = ' + format(k4, '#06x'))
 
-            third_round_key_possibilities = break_round_key(1, useful_diff_trails_1, round_keys)
+            third_round_key_possibilities = break_round_key(1, useful_diff_trails_1, round_keys, use_structures)
 
             for k3 in third_round_key_possibilities:
                 round_keys[2] = k3
 
-                second_round_key_possibilities = break_round_key(0, useful_diff_trails_0, round_keys)
+                second_round_key_possibilities = iter(break_round_key(0, useful_diff_trails_0, round_keys, use_structures))
+
+                # Nothing in here asks the oracle, so the KEY2 candidates
+                # can be tried in batches
+                while True:
+                    second_round_keys = list(itertools.islice(second_round_key_possibilities, CONFIRMATION_BATCH_SIZE))
 
-                for k2 in second_round_key_possibilities:
-                    round_keys[1] = k2
+                    if len(second_round_keys) == 0: break
 
                     # Special case for the first key
-                    round_keys[0] = break_first_round_key(round_keys)
+                    key_guesses = break_first_round_keys(round_keys, second_round_keys)
+
+                    confirmed_key_guess = find_confirmed_key_guess(key_guesses)
+
+                    if confirmed_key_guess is not None:
+                        return confirmed_key_guess
 
-                    if confirm_key_guesses(round_keys):
-                        end = time.time()
+    return None
 
-                        print('\nFound correct round keys in ' + str(round(end - start, 2)) + ' seconds!') 
+def find_confirmed_key_guess(key_guesses):
+    """
+    Given a list of 5 key combinations, returns the first one which
+    encrypts the known plaintexts (see get_known_pairs) to the correct
+    ciphertexts, or None if none of them do.
+
+    With NumPy, all combinations are checked at once. Otherwise they're
+    checked one by one with confirm_key_guesses.
+    """
 
-                        print('*****************')
-                        for i in range(len(round_keys)):
-                            print('  KEY' + str(i + 1) + ' = ' + format(round_keys[i], '#06x'))
-                        print('*****************')
+    ATTACK_STATS['confirmations'] += len(key_guesses)
 
-                        return
+    with time_stage('confirm key guesses'):
+        if np is None:
+            return next((k for k in key_guesses if confirm_key_guesses(k)), None)
 
+        plaintexts, ciphertexts = zip(*get_known_pairs())
 
+        keys = np.array(key_guesses, dtype=np.uint16)
 
-""" --- DIFFERENTIAL CRYPTANALYSIS --- """
+        # encryptions[i][j] is known plaintext j encrypted with combination i
+        encryptions = encrypt_batch(np.array(plaintexts, dtype=np.uint16)[None, :], *(keys[:, i, None] for i in range(5)))
+
+        confirmed = np.flatnonzero((encryptions == np.array(ciphertexts, dtype=np.uint16)).all(axis=1))
+
+    if len(confirmed) == 0: return None
+
+    return key_guesses[confirmed[0]]
 
 def confirm_key_guesses(round_keys):
     """
-    Given a 5 key combination, checks if it encrypts plaintexts to the
-    correct ciphertexts. Returns True if correct, False otherwise.
+    Given a 5 key combination, checks if it encrypts the known plaintexts
+    (see get_known_pairs) to the correct ciphertexts. Returns True if
+    correct, False otherwise. Most wrong combinations already fail on the
+    first plaintext.
     """
 
-    num_for_confirm = 5 # How many plaintexts needed for confimation
-
-    for i in range(num_for_confirm):
-        plaintext = choose_random_plaintext()
-
-        encryption_guess = encrypt(plaintext, round_keys[0], round_keys[1], round_keys[2], round_keys[3], round_keys[4])
-        encryption_correct = encrypt(plaintext, KEY1, KEY2, KEY3, KEY4, KEY5)
+    for plaintext, encryption_correct in get_known_pairs():
+        encryption_guess = fast_encrypt(plaintext, round_keys[0], round_keys[1], round_keys[2], round_keys[3], round_keys[4])
 
         if encryption_guess != encryption_correct:
             return False
 
     return True
 
-def break_round_key(round_num, useful_diff_trails, round_keys):
+def get_known_pairs():
+    """
+    Returns NUM_KNOWN_PAIRS (plaintext, ciphertext) pairs for random
+    plaintexts. The oracle is only asked for them the first time, for all
+    of them in one go.
+    """
+
+    if len(KNOWN_PAIRS) == 0:
+        plaintexts = [choose_random_plaintext() for i in range(NUM_KNOWN_PAIRS)]
+        ciphertexts = oracle_encrypt(plaintexts)
+
+        KNOWN_PAIRS.extend((plaintext, int(ciphertext)) for plaintext, ciphertext in zip(plaintexts, ciphertexts))
+
+    return KNOWN_PAIRS
+
+def break_round_key(round_num, useful_diff_trails, round_keys, use_structures=False):
     """
     Breaks a whole round key given some highly probable differential trails
     by choosing ones which will break keybits we have not yet broken until
     all key bits are broken/SBOXes are used.
 
-    Returns the most probable round keys in the order of their probability.
+    If use_structures is True, the chosen plaintexts of all trails come from
+    the same plaintext structures (see get_structure_pairs) instead of each
+    trail choosing its own.
+
+    Returns an iterator over the most probable round keys in the order of
+    their probability (see combine_partial_keys).
+
+    The chosen pairs are the same every time (see get_chosen_pairs), so
+    the result only depends on the round keys after this one. It's stored
+    in ROUND_KEY_CACHE and never found twice under the same hypothesis.
     """
 
+    cache_key = (round_num, tuple(round_keys[round_num + 2:]), tuple(useful_diff_trails), use_structures, MIN_OPTIONS)
+
+    if cache_key in ROUND_KEY_CACHE:
+        ATTACK_STATS['round_key_cache_hits'] += 1
+
+        return combine_partial_keys(ROUND_KEY_CACHE[cache_key])
+
+    start = time.perf_counter()
+
     total_key_bits_broken = 0
     partial_keys_to_combine = []
 
-    for useful_diff_trail in useful_diff_trails:
+    if use_structures:
+        all_ciphertext_pairs = get_structure_pairs(useful_diff_trails)
+    else:
+        all_ciphertext_pairs = [None] * len(useful_diff_trails)
+
+    # Adaptive sampling breaks all trails of the round key together, so that
+    # their pairs can be chosen in the same oracle round trips
+    if ADAPTIVE_ERROR_BOUND is not None and not use_structures:
+        all_broken_key_bits = break_trails_adaptively(round_num, useful_diff_trails, round_keys)
+    else:
+        all_broken_key_bits = [None] * len(useful_diff_trails)
+
+    for useful_diff_trail, ciphertext_pairs, broken_key_bits in zip(useful_diff_trails, all_ciphertext_pairs, all_broken_key_bits):
         probability = useful_diff_trail[1]
         input_xor = useful_diff_trail[2]
         output_xor = useful_diff_trail[3]
 
         breaking_key_bits = find_which_key_bits_will_be_broken(round_num, output_xor)
-        broken_key_bits = break_key_bits(round_num, probability, input_xor, output_xor, breaking_key_bits, round_keys)
+
+        if broken_key_bits is None:
+            broken_key_bits = break_key_bits(round_num, probability, input_xor, output_xor, breaking_key_bits, round_keys, ciphertext_pairs)
 
         # broken_key_bits now has some likely candidates for the partial
         # keys, ordered by their probabilities. At the end of the while
@@ -178,383 +511,2299 @@ def break_round_key(round_num, useful_diff_trails, round_keys):
 
         partial_keys_to_combine.append(broken_key_bits)
 
+    ROUND_KEY_CACHE[cache_key] = partial_keys_to_combine
+
     round_key_possibilities = combine_partial_keys(partial_keys_to_combine)
 
+    ATTACK_STATS['round_keys_broken'] += 1
+    record_stage_time(f'break KEY{round_num + 2}', time.perf_counter() - start)
+
     return round_key_possibilities
 
+def peek_round_key_possibilities(round_key_possibilities):
+    """
+    Takes a look at the first MIN_OPTIONS round key candidates of the
+    iterator round_key_possibilities (from break_round_key) to print them.
+    Returns them as a string, along with an iterator which still yields
+    every candidate, in this form:
+
+    (round_key_possibilities, string)
+
+    The candidates stay lazy: only one more than are printed is built, to
+    know whether there are more.
+    """
+
+    round_key_possibilities, peeked = itertools.tee(round_key_possibilities)
+
+    first_possibilities = list(itertools.islice(peeked, MIN_OPTIONS + 1))
+
+    string = get_hex_array(first_possibilities[:MIN_OPTIONS])
+
+    if len(first_possibilities) > MIN_OPTIONS:
+        string += ' ...'
+
+    return (round_key_possibilities, string)
+
 def combine_partial_keys(partial_keys_to_combine):
     """
     Given a list of lists, each internal list containing candidates for some
     partial keys, this function combines them into possible full round keys.
 
-    It does so in an ordered way: putting the most likely full round keys
-    to the beginning of the array. Since the partial key candidates
-    (internal lists) are already ordered by their own probabilities, we can
-    do this by ordering the full keys by the sum of the indicies of the
-    partial keys used to make up the full key.
+    It does so in an ordered way: generating the most likely full round
+    keys first. Since the partial key candidates (internal lists) are
+    already ordered by their own probabilities, we can do this by ordering
+    the full keys by the sum of the indicies of the partial keys used to
+    make up the full key (ties are broken by the key itself).
+
+    The full keys are generated lazily, best-first with a heap, so only as
+    many of them are built as are asked for. Lists without candidates are
+    skipped.
     """
 
-    full_keys = []
+    lists = [values for values in partial_keys_to_combine if len(values) > 0]
 
-    for partial_key_values in partial_keys_to_combine:
-        new_full_keys = []
+    if len(lists) == 0: return
 
-        if len(full_keys) == 0:
-            for i, partial_key_value in enumerate(partial_key_values):
-                new_full_keys.append((i, partial_key_value))
-        else:
-            for i, key in full_keys:
-                for j, partial_key_value in enumerate(partial_key_values):
-                    new_full_keys.append((i + j, partial_key_value | key))
+    def get_heap_entry(indicies):
+        key = 0
+
+        for values, i in zip(lists, indicies):
+            key |= values[i]
 
-        full_keys = new_full_keys
+        return (sum(indicies), key, indicies)
 
-    full_keys.sort()
+    heap = [get_heap_entry((0,) * len(lists))]
 
-    # Just take the keys. Don't care about the indicies anymore
-    full_keys = [k for i, k in full_keys]
+    while len(heap) > 0:
+        cost, key, indicies = heapq.heappop(heap)
 
-    return full_keys
+        yield key
 
-def break_key_bits(round_num, probability, input_xor, output_xor, breaking_key_bits, round_keys):
+        # Every combination of indicies has one parent: itself with the last
+        # nonzero index lowered by one. A combination is only pushed by its
+        # parent, after the parent itself is out, so it's pushed just once
+        # and never before anything cheaper
+        last = max([j for j in range(len(indicies)) if indicies[j] > 0], default=0)
+
+        for j in range(last, len(indicies)):
+            if indicies[j] + 1 < len(lists[j]):
+                heapq.heappush(heap, get_heap_entry(indicies[:j] + (indicies[j] + 1,) + indicies[j + 1:]))
+
+def break_key_bits(round_num, probability, input_xor, output_xor, breaking_key_bits, round_keys, ciphertext_pairs=None):
     """
     Breaks bits of the round key specified by the breaking_key_bits array by
     generating random plaintexts (i.e. gets a partial key).
 
+    If ciphertext_pairs is given (in the same form as encrypt_chosen_pairs
+    returns), those pairs are used instead of generating new ones.
+
     Returns the most probable keybits for the specified bits, in the order of
     their probability.
     """
 
-    key_count_dict = {}
-
     # We need some number of randomly chosen plaintexts. The simplest function
     # for choosing this number is to divide some constant by the probability
     # of the trail. The higher the probability, the fewer plaintexts are needed.
 
     num_chosen_plaintexts = round(C / probability)
 
-    for i in range(num_chosen_plaintexts):
-        text1 = choose_random_plaintext()
-        text2 = text1 ^ input_xor
+    if ciphertext_pairs is not None:
+        ciphertexts1, ciphertexts2 = ciphertext_pairs
 
-        # Now, text1 ^ text2 = input_xor and we can encrypt both
+        key_counts = count_key_bits(round_num, ciphertexts1, ciphertexts2, output_xor, breaking_key_bits, round_keys)
 
-        text1 = encrypt(text1, KEY1, KEY2, KEY3, KEY4, KEY5)
-        text2 = encrypt(text2, KEY1, KEY2, KEY3, KEY4, KEY5)
+        return get_most_probable_keys(key_counts, breaking_key_bits)
 
-        # This will modify the key_count_dict after key guesses
-        guess_key_bits(round_num, text1, text2, output_xor, key_count_dict, breaking_key_bits, round_keys)
+    key_counts = count_chosen_pairs(round_num, input_xor, output_xor, breaking_key_bits, round_keys, 0, num_chosen_plaintexts)
 
-    # Extract the most likely keys out of the dictonary
-    most_probable_keys = sorted(key_count_dict.items(), key=lambda x: x[1], reverse=True)
-    most_probable_keys = most_probable_keys[:MIN_OPTIONS]
-    most_probable_keys = [int(k[0], 16) for k in most_probable_keys]
+    return get_most_probable_keys(key_counts, breaking_key_bits)
 
-    return most_probable_keys
-
-def guess_key_bits(round_num, ciphertext1, ciphertext2, output_xor, key_count_dict, breaking_key_bits, round_keys):
+def break_trails_adaptively(round_num, useful_diff_trails, round_keys):
     """
-    For a given ciphertext pair, this function goes through every possible key
-    bit combination (specified by breaking_key_bits). It returns nothing.
-    Instead, it increments the values in key_count_dict whenever the highly-
-    likely output XOR matches the XOR of the partially decrypted ciphertexts.
+    Like calling break_key_bits for every trail of a round key, but instead
+    of choosing round(C / probability) pairs for every trail up front, the
+    pairs are chosen in steps, and a trail stops as soon as
+    keys_are_separated says its counts are conclusive. Every step doubles
+    the number of pairs of a trail, and the last one gets to all of them.
+
+    Every step chooses the pairs of all trails which are still running in
+    one oracle round trip (see prefetch_chosen_pairs), and there are at
+    most as many round trips as trails, which is what choosing all pairs up
+    front takes. The pairs are kept in CHOSEN_PAIRS, so breaking the round
+    key again under other round keys only chooses pairs which weren't
+    chosen yet. ADAPTIVE_ROUND_TRIPS keeps that within the same number of
+    round trips as well: the last one the round key has left chooses every
+    pair that any trail could still need.
+
+    Returns the most probable key bits of every trail, like break_key_bits.
     """
 
-    total_needed_key_guesses = int(math.pow(2, count_one_bits(breaking_key_bits)))
-
-    for i in range(total_needed_key_guesses):
-        key_guess_bits = 0
+    num_trails = len(useful_diff_trails)
+    round_trips_key = (round_num, tuple(useful_diff_trail[2] for useful_diff_trail in useful_diff_trails))
 
-        div = total_needed_key_guesses / 2
+    all_breaking_key_bits = []
+    all_match_rates = []
+    all_max_pairs = []
+    all_checkpoints = []
 
-        # This for loop is hard to understand but, as the outer for loop is
-        # looping, it will loop thorough all possible keys only for the bits
-        # where breaking_key_bits is set
-        for j in range(16):
-            if get_bit(breaking_key_bits, j) == 1:
-                if i > div - 1 and i % (div * 2) >= div:
-                    key_guess_bits = set_bit(key_guess_bits, j, 1)
+    for useful_diff_trail in useful_diff_trails:
+        probability = useful_diff_trail[1]
+        output_xor = useful_diff_trail[3]
 
-                div /= 2
+        match_rates = get_match_rates(probability, output_xor)
+        max_pairs = round(C / probability)
 
-        # Set round key so partial_decryption will use it
-        round_keys[round_num + 1] = key_guess_bits
+        all_breaking_key_bits.append(find_which_key_bits_will_be_broken(round_num, output_xor))
+        all_match_rates.append(match_rates)
+        all_max_pairs.append(max_pairs)
 
-        partial_xor = partial_decryption(round_num, ciphertext1, ciphertext2, round_keys)
+        # The number of pairs doubles with every step, up to max_pairs
+        all_checkpoints.append([math.ceil(max_pairs / 2 ** (num_trails - 1 - step)) for step in range(num_trails)])
 
-        # Make the dictionary keys a string so it's easier to debug
-        key_as_string = format(key_guess_bits, '#06x')
+    all_key_counts = [None] * num_trails
+    all_num_pairs = [0] * num_trails
 
-        # If the XORs match, increment value in dictionary 
-        if partial_xor == output_xor:
-            if key_as_string not in key_count_dict:
-                key_count_dict[key_as_string] = 1
-            else:
-                key_count_dict[key_as_string] += 1
+    running = list(range(num_trails))
 
-def break_first_round_key(round_keys):
-    """
-    For the first key, we don't need anything special. Just decrypt a random
-    encrypted plaintext all the way to the key with the keys we've already
-    broken and then XOR that value with the original plaintext.
-    """
+    for step in range(num_trails):
+        if len(running) == 0: break
 
-    # Encrypt random plaintext
-    plaintext = choose_random_plaintext()
-    ciphertext = encrypt(plaintext, KEY1, KEY2, KEY3, KEY4, KEY5)
+        num_pairs_needed = [(useful_diff_trails[i][2], all_checkpoints[i][step]) for i in running]
 
-    # Decrypt ciphertext all the way to last xor with the round_keys we found
-    ciphertext = add_round_key(ciphertext, round_keys[4])
-    ciphertext = substitute(ciphertext, INV_SBOX)
+        if count_missing_chosen_pairs(num_pairs_needed) > 0:
+            round_trips = ADAPTIVE_ROUND_TRIPS.get(round_trips_key, 0)
 
-    ciphertext = add_round_key(ciphertext, round_keys[3])
-    ciphertext = permutate(ciphertext, INV_PBOX)
-    ciphertext = substitute(ciphertext, INV_SBOX)
+            if round_trips + 1 >= num_trails:
+                num_pairs_needed = [(useful_diff_trails[i][2], all_max_pairs[i]) for i in range(num_trails)]
 
-    ciphertext = add_round_key(ciphertext, round_keys[2])
-    ciphertext = permutate(ciphertext, INV_PBOX)
-    ciphertext = substitute(ciphertext, INV_SBOX)
+            prefetch_chosen_pairs(num_pairs_needed)
 
-    ciphertext = add_round_key(ciphertext, round_keys[1])
-    ciphertext = permutate(ciphertext, INV_PBOX)
-    ciphertext = substitute(ciphertext, INV_SBOX)
+            ADAPTIVE_ROUND_TRIPS[round_trips_key] = round_trips + 1
 
-    # Get the last key
-    return plaintext ^ ciphertext
+        for i in running:
+            input_xor = useful_diff_trails[i][2]
+            output_xor = useful_diff_trails[i][3]
+            num_pairs = all_checkpoints[i][step] - all_num_pairs[i]
 
-def partial_decryption(round_num, ciphertext1, ciphertext2, round_keys):
-    """
-    This function partially decrypts ciphertext1 and ciphertext2 using
-    round_keys up to round_num. It returns their XOR after partial decryption.
-    """
+            # Progress is reported towards the end of the step, as the trail
+            # might stop there
+            key_counts = count_chosen_pairs(round_num, input_xor, output_xor, all_breaking_key_bits[i], round_keys,
+                                            all_num_pairs[i], num_pairs, all_checkpoints[i][step])
 
-    for i in range(4, round_num, -1):
-        ciphertext1 = add_round_key(ciphertext1, round_keys[i])
-        ciphertext2 = add_round_key(ciphertext2, round_keys[i])
+            all_key_counts[i] = add_key_counts(all_key_counts[i], key_counts)
+            all_num_pairs[i] += num_pairs
 
-        if i < 4:
-            ciphertext1 = permutate(ciphertext1, INV_PBOX)
-            ciphertext2 = permutate(ciphertext2, INV_PBOX)
+        running = [i for i in running if all_num_pairs[i] < all_max_pairs[i]
+                   and not keys_are_separated(all_key_counts[i], all_num_pairs[i], all_match_rates[i])]
 
-        ciphertext1 = substitute(ciphertext1, INV_SBOX)
-        ciphertext2 = substitute(ciphertext2, INV_SBOX)
+    ADAPTIVE_STATS['pairs'] += sum(all_num_pairs)
+    ADAPTIVE_STATS['max_pairs'] += sum(all_max_pairs)
 
-    partial_xor = ciphertext1 ^ ciphertext2
-        
-    return partial_xor
+    return [get_most_probable_keys(key_counts, breaking_key_bits) for key_counts, breaking_key_bits in zip(all_key_counts, all_breaking_key_bits)]
 
-def find_which_key_bits_will_be_broken(round_num, output_xor):
+def get_match_rates(probability, output_xor):
     """
-    In order to guess key bits we need to know which bits to guess. This
-    function returns a bit string with 1 bits representing bits which we're
-    attempting to break given the output_xor and round_num.
+    Returns the probability that a chosen pair of a trail with the given
+    probability and output XOR matches the right key guess, and the highest
+    probability that it matches a wrong key guess, in this form:
+
+    (right_rate, wrong_rate)
+
+    Any pair matches any key guess with probability 2^-16, as its partially
+    decrypted XOR is random, and a right pair always matches the right key
+    guess. The wrong key guesses which match right pairs the most are the
+    ones which are only off in one active SBOX, so the highest wrong rate
+    is the highest rate at which some key nibble off by d matches, going
+    through every active SBOX and every d.
     """
 
-    breaking_key_bits = 0
+    highest_rate = 0
 
     for i in range(4):
-        if get_nibble(output_xor, i) != 0:
-            breaking_key_bits = set_nibble(breaking_key_bits, i, 0xf)
+        nibble_xor = get_nibble(output_xor, i)
 
-    if round_num < 3: # If round_num < 3 we need to take the permutation into account
-        breaking_key_bits = permutate(breaking_key_bits, PBOX)
-        
-    return breaking_key_bits
+        if nibble_xor == 0: continue
 
-def find_differential_trails_to_break_full_key(round_num, most_probable_diff_trails):
+        # The right pair goes into the SBOX as x and x ^ nibble_xor
+        for d in range(1, 16):
+            num_matches = sum(INV_SBOX[SBOX[x] ^ d] ^ INV_SBOX[SBOX[x ^ nibble_xor] ^ d] == nibble_xor for x in range(16))
+
+            highest_rate = max(highest_rate, num_matches / 16)
+
+    random_rate = (1 - probability) * 2 ** -16
+
+    return (probability + random_rate, probability * highest_rate + random_rate)
+
+def count_chosen_pairs(round_num, input_xor, output_xor, breaking_key_bits, round_keys, start, num_pairs, total_pairs=None):
     """
-    Uses the find_useful_diff_trail function to find a combination of useful
-    diff trails which together break the full key.
+    Counts the key guesses (see count_key_bits) for the chosen pairs start
+    to start + num_pairs of the trail with the given input XOR.
+
+    The pairs go through the pipeline one chunk at a time: every chunk is
+    chosen, encrypted, filtered and counted before the next one is even
+    chosen, and only the key counts are kept in between. total_pairs is
+    what the progress report counts towards, num_pairs if not given.
     """
 
-    useful_diff_trails = []
-    sboxes_already_used = [False, False, False, False]
+    if total_pairs is None:
+        total_pairs = num_pairs
 
-    while not all(sboxes_already_used):
-        useful_diff_trail = find_useful_diff_trail(round_num, most_probable_diff_trails, sboxes_already_used)
+    key_counts = None
 
-        output_xor = useful_diff_trail[3]
+    for ciphertexts1, ciphertexts2 in iterate_chosen_pair_chunks(input_xor, num_pairs, start):
+        chunk_key_counts = count_key_bits(round_num, ciphertexts1, ciphertexts2, output_xor, breaking_key_bits, round_keys)
+        key_counts = add_key_counts(key_counts, chunk_key_counts)
 
-        # Mark which sboxes this used up
-        for i in range(4):
-            if get_nibble(output_xor, i) != 0:
-                sboxes_already_used[i] = True
+        start += len(ciphertexts1)
 
-        useful_diff_trails.append(useful_diff_trail)
+        if SHOW_PROGRESS and total_pairs > PAIR_CHUNK_SIZE:
+            report_progress(round_num, input_xor, start, total_pairs)
 
-    return useful_diff_trails
+    return key_counts
 
-def find_useful_diff_trail(round_num, most_probable_diff_trails, sboxes_already_used):
+def iterate_chosen_pair_chunks(input_xor, num_pairs, start=0):
     """
-    We should only use a differtial trail if it breaks key bits which we
-    haven't broken before. This function finds such a differential trail.
+    Yields the chosen pairs start to start + num_pairs of the trail with the
+    given input XOR in chunks of at most PAIR_CHUNK_SIZE pairs, in the same
+    form as encrypt_chosen_pairs. Every chunk is only chosen (or taken from
+    CHOSEN_PAIRS) when it's asked for.
     """
 
-    for diff_trail in most_probable_diff_trails:
-        output_xor = diff_trail[3]
+    end = start + num_pairs
 
-        # Check if this diff_trail will use any sboxes which we haven't used already
-        for i in range(4):
-            if get_nibble(output_xor, i) != 0 and sboxes_already_used[i] == False: # Hit! We can use this one
-                return diff_trail
+    # Always yield at least one (maybe empty) chunk, so there are always
+    # key counts to return
+    yield get_chosen_pairs(input_xor, min(PAIR_CHUNK_SIZE, num_pairs), start)
 
-def find_highly_probable_differential_trails(diff_dist_table, round_num):
-    """
-    Finds a highly probable differential trails for every possible input XOR,
-    with the help of the find_differential_trail function.
+    for chunk_start in range(start + PAIR_CHUNK_SIZE, end, PAIR_CHUNK_SIZE):
+        yield get_chosen_pairs(input_xor, min(PAIR_CHUNK_SIZE, end - chunk_start), chunk_start)
 
-    Returns a list of differential trails in this form:
+def report_progress(round_num, input_xor, num_pairs, total_pairs):
+    line = f'KEY{round_num + 2} trail {format(input_xor, "#06x")}: {num_pairs} of {total_pairs} pairs ({round(100 * num_pairs / total_pairs, 1)}%)'
 
-    (preference, input_xor, output_xor)
+    print('\r' + line, end='\n' if num_pairs >= total_pairs else '', file=sys.stderr, flush=True)
+
+def count_key_bits(round_num, ciphertexts1, ciphertexts2, output_xor, breaking_key_bits, round_keys):
     """
+    Counts, for every key guess of the bits in breaking_key_bits, how many
+    of the ciphertext pairs partially decrypt to output_xor.
 
-    differential_trails = []
+    Returns the counts as key counts: a flat integer array with an entry
+    for every key guess, indexed by the compressed key guess (see
+    new_key_counts).
+    """
 
-    for i in range(16):
-        for j in range(16):
-            for k in range(16):
-                for l in range(16):
+    # Most pairs can't be right pairs, so don't waste key guesses on them.
+    # The survivors come back partially decrypted through the known rounds,
+    # which is all that compressing and counting need
+    num_pairs = len(ciphertexts1)
+    states1, states2 = filter_right_pair_candidates(round_num, ciphertexts1, ciphertexts2, output_xor, round_keys)
 
-                    if i == 0 and j == 0 and k == 0 and l == 0: continue # We don't care about all zero xors
+    # Pairs which look the same to every key guess only need to be guessed
+    # once. This bounds the work by the size of the histogram instead of
+    # the number of pairs
+    num_counted = len(states1)
+    states1, states2, weights = compress_pairs(states1, states2, output_xor)
 
-                    input_xor = 0
+    record_key_guess_stats(num_pairs, num_counted, len(weights), breaking_key_bits)
 
-                    input_xor = set_nibble(input_xor, 0, l)
-                    input_xor = set_nibble(input_xor, 1, k)
-                    input_xor = set_nibble(input_xor, 2, j)
-                    input_xor = set_nibble(input_xor, 3, i)
+    # With NumPy, count matches for all pairs and all key guesses at once.
+    # With workers and enough key guesses (see PARALLEL_MIN_KEY_GUESSES),
+    # every worker counts a chunk of the pairs and the partial counts are
+    # added up
+    count_function = count_key_guesses if np is not None else guess_key_bits_for_pairs
 
-                    output_xor, probability, preference = find_differential_trail(input_xor, diff_dist_table, round_num)
+    parallel = len(weights) << count_one_bits(breaking_key_bits) >= PARALLEL_MIN_KEY_GUESSES
 
-                    differential_trails.append((preference, probability, input_xor, output_xor))
+    partial_key_counts = map_over_pair_chunks(count_function, round_num, states1, states2, weights, output_xor, breaking_key_bits, parallel=parallel)
 
-    differential_trails.sort(reverse=True)
+    key_counts = None
 
-    return differential_trails
+    for chunk_key_counts in partial_key_counts:
+        key_counts = add_key_counts(key_counts, chunk_key_counts)
 
-def find_differential_trail(input_xor, diff_dist_table, round_num):
+    return key_counts
+
+def compress_pairs(states1, states2, output_xor):
     """
-    Greedily finds a highly probable differential trail of length round_num
-    with a certain input XOR. Note that because it's greedy (always takes the
-    most likely SBOX output XOR) it's not necessarily the most probable.
+    Whether a pair which survived filter_right_pair_candidates matches a
+    key guess only depends on the nibbles of the active SBOXes (in
+    output_xor) of both partially decrypted states. This function builds a
+    histogram over those nibbles: pairs with the same nibbles are replaced
+    by the first of them, weighted by how many there were.
 
-    Returns the final XOR, the trail's raw probability, and its "preference"
-    which depends on the final number of active SBOXes in this form:
+    With one or two active SBOXes, there are at most 256 or 65536 distinct
+    pairs, however many pairs were chosen.
 
-    (final_xor, probability, preference)
+    Returns the first pair of states of every bin, in the order they came
+    in, and the weights, in this form:
+
+    (states1, states2, weights)
     """
 
-    probability = 1
+    active_nibbles = [i for i in range(4) if get_nibble(output_xor, i) != 0]
 
-    current_xor = input_xor
+    if np is not None:
+        # 8 bits for every active SBOX, the nibble of both states
+        codes = np.zeros(len(states1), dtype=np.int64)
 
-    for r in range(round_num):
-        # XOR doesn't change over key addition, so we can just ignore it
+        for i in active_nibbles:
+            codes = (codes << 8) | (((states1 >> (4 * i)) & 0xf) << 4) | ((states2 >> (4 * i)) & 0xf)
 
-        # XOR going through sbox changes the probability (non-linear)
-        for i in range(4):
-            if get_nibble(current_xor, i) > 0: # SBOX is active
+        codes, firsts, weights = np.unique(codes, return_index=True, return_counts=True)
 
-                # Get max entry in diff_dist row and adjust probability based on that
-                max_count = max(diff_dist_table[get_nibble(current_xor, i)])
-                most_probable_output_xor = diff_dist_table[get_nibble(current_xor, i)].index(max_count)
+        order = np.argsort(firsts)
+        firsts = firsts[order]
 
-                probability *= max_count / 16
+        return (states1[firsts], states2[firsts], weights[order])
 
-                current_xor = set_nibble(current_xor, i, most_probable_output_xor)
+    bins = {}
 
-        # XOR changes over permutation, but the probability is not affected (linear)
-        current_xor = permutate(current_xor, PBOX)
+    for state1, state2 in zip(states1, states2):
+        code = tuple((get_nibble(state1, i), get_nibble(state2, i)) for i in active_nibbles)
 
+        if code in bins:
+            bins[code][2] += 1
+        else:
+            bins[code] = [state1, state2, 1]
 
-    # If we get a highly probable trail which has all the final SBOXes active,
-    # we'll have to break a whole round key at once. It's much better to find
-    # a trail with few final SBOXes active so we can break smaller portions of
-    # the round key at a time. This is why we assign a "preference" to each
-    # trail which is a function of the trail's probability and its number of
-    # final active SBOXes.
+    return ([b[0] for b in bins.values()], [b[1] for b in bins.values()], [b[2] for b in bins.values()])
 
-    num_final_active_sboxes = 0
-    
-    for i in range(4):
-        if get_nibble(current_xor, i) > 0:
-            num_final_active_sboxes += 1
+def new_key_counts(breaking_key_bits):
+    """
+    Returns key counts for the bits in breaking_key_bits with every count at
+    zero. Key counts are a flat integer array with an entry for each of the
+    2^count_one_bits(breaking_key_bits) key guesses, indexed by the
+    compressed key guess: its position in the table of get_key_guesses,
+    which also turns an index back into the key guess.
 
-    preference = probability
+    With NumPy, the array is an int64 NumPy array. Otherwise it's a list.
+    """
 
-    # 1 active SBOX: perfect
-    # 2 active SBOXes: the key bits are broken within a couple of seconds. We 
-    #                  won't adjust preference since it's fast enough and only
-    #                  1 active SBOX is not likely anyway
-    # 3 active SBOXes: could take longer sec so divide preference by some
-    #                  constant to discourage using it.
-    # 4 active SBOXes: will take a very long time so we never want to use them. 
-    #                  We set preference to zero so we'll try to find 
-    #                  alternatives with fewer active sboxes
+    num_key_guesses = 1 << count_one_bits(breaking_key_bits)
 
-    if num_final_active_sboxes == 3: preference /= 4
-    if num_final_active_sboxes == 4: preference = 0
+    if np is not None:
+        return np.zeros(num_key_guesses, dtype=np.int64)
 
-    return (current_xor, probability, preference)
+    return [0] * num_key_guesses
 
-def build_difference_distribution_table(sbox):
-    diff_dist_table = [[0 for i in range(len(sbox))] for j in range(len(sbox))]
+def add_key_counts(key_counts, other_key_counts):
+    """
+    Adds up two key counts (see new_key_counts), e.g. the counts of two
+    batches of pairs. key_counts may be None, in which case
+    other_key_counts is returned.
+    """
 
-    for x_prime in range(16):
-        for x in range(16):
-            x_star = x ^ x_prime
-            y_prime = sbox[x] ^ sbox[x_star]
+    if key_counts is None:
+        return other_key_counts
 
-            diff_dist_table[x_prime][y_prime] += 1
+    if np is not None:
+        return key_counts + other_key_counts
 
-    return diff_dist_table
+    return [a + b for a, b in zip(key_counts, other_key_counts)]
 
-def choose_random_plaintext():
-    return random.randint(0, 0xffff)
+def get_top_key_guesses(key_counts, num):
+    """
+    Returns the indices (compressed key guesses) of the num highest key
+    counts, from highest to lowest count. Ties go to the smallest index.
 
+    Only the top num are selected, the rest of the counts is never sorted.
+    """
 
+    num = min(num, len(key_counts))
 
-""" --- SPN CIPHER IMPLEMENTATION --- """
+    if num == 0: return []
 
-def encrypt(state, key1, key2, key3, key4, key5):
-    state = add_round_key(state, key1)
-    state = substitute(state, SBOX)
-    state = permutate(state, PBOX)
+    if np is None:
+        return heapq.nsmallest(num, range(len(key_counts)), key=lambda i: (-key_counts[i], i))
 
-    state = add_round_key(state, key2)
-    state = substitute(state, SBOX)
-    state = permutate(state, PBOX)
+    # Every count above the num-th highest one is in the top num. Counts
+    # equal to it are taken in order of their index until there's enough
+    threshold = np.partition(key_counts, len(key_counts) - num)[len(key_counts) - num]
+    candidates = np.flatnonzero(key_counts >= threshold)
 
-    state = add_round_key(state, key3)
-    state = substitute(state, SBOX)
-    state = permutate(state, PBOX)
+    order = np.argsort(-key_counts[candidates], kind='stable')[:num]
 
-    state = add_round_key(state, key4)
-    state = substitute(state, SBOX)
+    return candidates[order].tolist()
 
-    state = add_round_key(state, key5)
+def keys_are_separated(key_counts, num_pairs, match_rates):
+    """
+    Decides whether the key guesses counted so far over num_pairs chosen
+    pairs are conclusive, so that adaptive sampling can stop choosing
+    pairs. match_rates are the match rates of the trail, see
+    get_match_rates.
+
+    Only the MIN_OPTIONS key guesses with the most matches are kept, so
+    what matters is that the right key guess isn't thrown away. This is a
+    sequential probability ratio test on the best count thrown away (the
+    one right after the top MIN_OPTIONS): it's ruled out as the count of
+    the right key guess once it's 1 / ADAPTIVE_ERROR_BOUND times more likely
+    at the wrong key match rate than at the right one. Every lower count is
+    ruled out even more, so then none of the key guesses thrown away can be
+    the right one.
+
+    For the right key guess, the likelihood ratio starts at 1 and stays 1
+    on average with every pair. By Ville's inequality, the chance that it
+    ever reaches 1 / ADAPTIVE_ERROR_BOUND is at most ADAPTIVE_ERROR_BOUND,
+    so the bound holds for all checks of a trail together, however many
+    there are.
+    """
 
-    return state
+    top_counts = get_top_key_counts(key_counts, MIN_OPTIONS + 1)
 
-def decrypt(state, key1, key2, key3, key4, key5):
-    state = add_round_key(state, key5)
+    # Nothing is thrown away
+    if len(top_counts) <= MIN_OPTIONS: return False
 
-    state = substitute(state, INV_SBOX)
-    state = add_round_key(state, key4)
+    right_rate, wrong_rate = match_rates
+    thrown_away_count = top_counts[MIN_OPTIONS]
 
-    state = permutate(state, INV_PBOX)
-    state = substitute(state, INV_SBOX)
-    state = add_round_key(state, key3)
+    # The right key guess matches every pair
+    if right_rate >= 1: return thrown_away_count < num_pairs
 
-    state = permutate(state, INV_PBOX)
-    state = substitute(state, INV_SBOX)
-    state = add_round_key(state, key2)
+    if wrong_rate >= right_rate: return False
 
-    state = permutate(state, INV_PBOX)
-    state = substitute(state, INV_SBOX)
-    state = add_round_key(state, key1)
+    log_ratio = (thrown_away_count * math.log(wrong_rate / right_rate)
+                 + (num_pairs - thrown_away_count) * math.log((1 - wrong_rate) / (1 - right_rate)))
 
-    return state
+    return log_ratio >= math.log(1 / ADAPTIVE_ERROR_BOUND)
+
+def get_top_key_counts(key_counts, num):
+    """
+    Returns the num highest counts out of a result of count_key_bits, from
+    highest to lowest.
+    """
+
+    return [int(key_counts[i]) for i in get_top_key_guesses(key_counts, num)]
+
+def encrypt_chosen_pairs(input_xor, num_pairs):
+    """
+    Chooses num_pairs random plaintext pairs which XOR to input_xor and
+    encrypts them. Returns the two ciphertexts of every pair in this form:
+
+    (ciphertexts1, ciphertexts2)
+
+    With NumPy, all plaintexts are encrypted in one shot and the ciphertexts
+    are uint16 arrays. Otherwise they are lists.
+    """
+
+    return encrypt_chosen_pairs_of_trails([(input_xor, num_pairs)])[0]
+
+def encrypt_chosen_pairs_of_trails(num_pairs_of_trails):
+    """
+    Like encrypt_chosen_pairs for several trails at once. num_pairs_of_trails
+    is a list of (input_xor, num_pairs) tuples. The plaintexts of every
+    trail are sent to the oracle in one query, and the pairs of every trail
+    are returned in a list, in the same order.
+    """
+
+    all_plaintexts = []
+
+    # Both halves of every pair are sent to the oracle in one go
+    for input_xor, num_pairs in num_pairs_of_trails:
+        if np is not None:
+            plaintexts1 = choose_random_plaintexts(num_pairs)
+            plaintexts2 = plaintexts1 ^ input_xor # Now, plaintexts1 ^ plaintexts2 = input_xor
+        else:
+            plaintexts1 = [choose_random_plaintext() for i in range(num_pairs)]
+            plaintexts2 = [text1 ^ input_xor for text1 in plaintexts1]
+
+        all_plaintexts += [plaintexts1, plaintexts2]
+
+    if np is not None:
+        ciphertexts = oracle_encrypt(np.concatenate(all_plaintexts))
+    else:
+        ciphertexts = oracle_encrypt([text for plaintexts in all_plaintexts for text in plaintexts])
+
+    all_pairs = []
+    start = 0
+
+    for input_xor, num_pairs in num_pairs_of_trails:
+        all_pairs.append((ciphertexts[start:start + num_pairs], ciphertexts[start + num_pairs:start + 2 * num_pairs]))
+
+        start += 2 * num_pairs
+
+    return all_pairs
+
+def prefetch_chosen_pairs(num_pairs_of_trails):
+    """
+    Makes sure that CHOSEN_PAIRS holds the first num_pairs pairs (or
+    MAX_CACHED_PAIRS, if that's fewer) of every trail in num_pairs_of_trails,
+    a list of (input_xor, num_pairs) tuples. The missing pairs of all trails
+    are chosen in one oracle query.
+    """
+
+    num_missing_pairs = {}
+
+    for input_xor, num_pairs in num_pairs_of_trails:
+        num_missing_pairs[input_xor] = max(num_missing_pairs.get(input_xor, 0), count_missing_chosen_pairs([(input_xor, num_pairs)]))
+
+    num_missing_pairs = [(input_xor, num_pairs) for input_xor, num_pairs in num_missing_pairs.items() if num_pairs > 0]
+
+    if len(num_missing_pairs) == 0: return
+
+    for (input_xor, num_pairs), new_pairs in zip(num_missing_pairs, encrypt_chosen_pairs_of_trails(num_missing_pairs)):
+        CHOSEN_PAIRS[input_xor] = concatenate_pairs(CHOSEN_PAIRS.get(input_xor, ([], [])), new_pairs)
+
+def count_missing_chosen_pairs(num_pairs_of_trails):
+    """
+    Returns how many of the first num_pairs pairs (up to MAX_CACHED_PAIRS)
+    of every trail in num_pairs_of_trails, a list of (input_xor, num_pairs)
+    tuples, aren't in CHOSEN_PAIRS yet.
+    """
+
+    num_missing_pairs = 0
+
+    for input_xor, num_pairs in num_pairs_of_trails:
+        num_missing_pairs += max(0, min(num_pairs, MAX_CACHED_PAIRS) - len(CHOSEN_PAIRS.get(input_xor, ([], []))[0]))
+
+    return num_missing_pairs
+
+def get_chosen_pairs(input_xor, num_pairs, start=0):
+    """
+    Returns the chosen pairs start to start + num_pairs of the trail with
+    the given input XOR, in the same form as encrypt_chosen_pairs. Pairs
+    are only chosen (and encrypted) the first time they're asked for, and
+    kept in CHOSEN_PAIRS after that.
+
+    Only the first MAX_CACHED_PAIRS pairs are kept. Pairs beyond those are
+    chosen again on every call and forgotten by the caller, which bounds
+    the memory of very large numbers of pairs.
+    """
+
+    end = start + num_pairs
+    cached_end = min(end, MAX_CACHED_PAIRS)
+
+    ciphertexts1, ciphertexts2 = CHOSEN_PAIRS.get(input_xor, ([], []))
+
+    if len(ciphertexts1) < cached_end:
+        new_pairs = encrypt_chosen_pairs(input_xor, cached_end - len(ciphertexts1))
+        ciphertexts1, ciphertexts2 = concatenate_pairs((ciphertexts1, ciphertexts2), new_pairs)
+
+        CHOSEN_PAIRS[input_xor] = (ciphertexts1, ciphertexts2)
+
+    pairs = (ciphertexts1[start:end], ciphertexts2[start:end])
+
+    uncached_start = max(start, len(ciphertexts1))
+
+    if uncached_start < end:
+        pairs = concatenate_pairs(pairs, encrypt_chosen_pairs(input_xor, end - uncached_start))
+
+    return pairs
+
+def concatenate_pairs(pairs, other_pairs):
+    """
+    Concatenates two sets of ciphertext pairs in the form encrypt_chosen_pairs
+    returns them.
+    """
+
+    ciphertexts1, ciphertexts2 = pairs
+    other_ciphertexts1, other_ciphertexts2 = other_pairs
+
+    if np is not None:
+        return (np.concatenate((np.asarray(ciphertexts1, dtype=np.uint16), other_ciphertexts1)),
+                np.concatenate((np.asarray(ciphertexts2, dtype=np.uint16), other_ciphertexts2)))
+
+    return (list(ciphertexts1) + other_ciphertexts1, list(ciphertexts2) + other_ciphertexts2)
+
+def get_structure_pairs(useful_diff_trails):
+    """
+    Instead of choosing separate random plaintext pairs for every trail, we
+    can choose plaintext "structures": sets of plaintexts which are closed
+    under XOR with the input XORs of all the trails. A structure is a random
+    plaintext XORed with every XOR combination of the input XORs, so every
+    plaintext in it has a partner for every trail. One batch of encryptions
+    then gives pairs for all the trails at once.
+
+    Structures are kept for the rest of the attack, so any later trails
+    whose input XORs are combinations of the same ones reuse them.
+
+    Returns the ciphertext pairs for every trail, each in the same form as
+    encrypt_chosen_pairs returns.
+    """
+
+    input_xors = [useful_diff_trail[2] for useful_diff_trail in useful_diff_trails]
+    nums_needed = [round(C / useful_diff_trail[1]) for useful_diff_trail in useful_diff_trails]
+
+    # Two queries for every pair is what choosing pairs per trail costs.
+    # Those pairs would be reused too (see get_chosen_pairs), so only pairs
+    # beyond the ones chosen for the trail before count
+    for input_xor, num_needed in zip(input_xors, nums_needed):
+        num_chosen = PER_TRAIL_PAIRS.get(input_xor, 0)
+
+        if num_needed > num_chosen:
+            STRUCTURE_STATS['per_trail_queries'] += 2 * (num_needed - num_chosen)
+            PER_TRAIL_PAIRS[input_xor] = num_needed
+
+    structures = find_structures(input_xors)
+
+    pairs_per_structure = len(structures['span']) // 2
+
+    extend_structures(structures, math.ceil(max(nums_needed) / pairs_per_structure))
+
+    return [get_pairs_from_structures(structures, input_xor, num_needed) for input_xor, num_needed in zip(input_xors, nums_needed)]
+
+def find_structures(input_xors):
+    """
+    Returns the collected structures which work for all input_xors, or
+    starts a new empty collection if there are none. Structures work for an
+    input XOR if it's in the span of their basis.
+    """
+
+    for structures in STRUCTURES:
+        if all(reduce_by_xor_basis(input_xor, structures['basis']) == 0 for input_xor in input_xors):
+            return structures
+
+    basis = find_xor_basis(input_xors)
+
+    # All XOR combinations of the basis
+    span = [0]
+
+    for vector in basis:
+        span += [v ^ vector for v in span]
+
+    structures = {'basis': basis, 'span': span, 'bases': [], 'ciphertexts': []}
+
+    STRUCTURES.append(structures)
+
+    return structures
+
+def extend_structures(structures, num_structures):
+    """
+    Encrypts new structures until there are num_structures of them (or until
+    every possible structure is used).
+
+    The random plaintext a structure starts from is reduced by the basis, so
+    two structures never share plaintexts.
+    """
+
+    used_bases = set(structures['bases'])
+    new_bases = []
+
+    num_possible = 0x10000 // len(structures['span'])
+
+    while len(structures['bases']) + len(new_bases) < min(num_structures, num_possible):
+        base = reduce_by_xor_basis(choose_random_plaintext(), structures['basis'])
+
+        if base in used_bases: continue
+
+        used_bases.add(base)
+        new_bases.append(base)
+
+    if len(new_bases) == 0: return
+
+    plaintexts = [base ^ v for base in new_bases for v in structures['span']]
+
+    if np is not None:
+        plaintexts = np.array(plaintexts, dtype=np.uint16)
+
+    ciphertexts = oracle_encrypt(plaintexts)
+
+    STRUCTURE_STATS['queries'] += len(plaintexts)
+
+    structures['bases'] += new_bases
+
+    if np is not None:
+        structures['ciphertexts'] = np.concatenate((np.asarray(structures['ciphertexts'], dtype=np.uint16), ciphertexts))
+    else:
+        structures['ciphertexts'] += ciphertexts
+
+def get_pairs_from_structures(structures, input_xor, num_pairs):
+    """
+    Returns (at most) num_pairs ciphertext pairs whose plaintexts XOR to
+    input_xor from the structures, in the same form as encrypt_chosen_pairs.
+    """
+
+    span = structures['span']
+    size = len(span)
+
+    # Position of every XOR combination within a structure. Each pair
+    # is taken once, from the plaintext with the lower position
+    positions = {v: j for j, v in enumerate(span)}
+
+    firsts = [j for j, v in enumerate(span) if j < positions[v ^ input_xor]]
+    seconds = [positions[span[j] ^ input_xor] for j in firsts]
+
+    num_structures = len(structures['bases'])
+    ciphertexts = structures['ciphertexts']
+
+    if np is not None:
+        offsets = np.arange(num_structures)[:, None] * size
+
+        indices1 = (offsets + np.array(firsts)[None, :]).ravel()[:num_pairs]
+        indices2 = (offsets + np.array(seconds)[None, :]).ravel()[:num_pairs]
+
+        return (ciphertexts[indices1], ciphertexts[indices2])
+
+    indices = [(k * size + j1, k * size + j2) for k in range(num_structures) for j1, j2 in zip(firsts, seconds)][:num_pairs]
+
+    return ([ciphertexts[i1] for i1, i2 in indices], [ciphertexts[i2] for i1, i2 in indices])
+
+def use_adaptive_sampling(error_bound):
+    global ADAPTIVE_ERROR_BOUND
+
+    ADAPTIVE_ERROR_BOUND = error_bound
+
+def use_pair_streaming(chunk_size, show_progress):
+    global PAIR_CHUNK_SIZE, SHOW_PROGRESS
+
+    PAIR_CHUNK_SIZE = chunk_size
+    SHOW_PROGRESS = show_progress
+
+def get_adaptive_stats_string():
+    pairs = ADAPTIVE_STATS['pairs']
+    max_pairs = ADAPTIVE_STATS['max_pairs']
+
+    string = f'Adaptive sampling: {pairs} of at most {max_pairs} pairs chosen'
+
+    if max_pairs > 0:
+        string += f' ({round(100 * (1 - pairs / max_pairs), 2)}% fewer)'
+
+    return string
+
+def get_structure_stats_string():
+    queries = STRUCTURE_STATS['queries']
+    per_trail_queries = STRUCTURE_STATS['per_trail_queries']
+
+    string = f'Plaintext structures: {queries} oracle queries instead of {per_trail_queries} with per-trail sampling'
+
+    if per_trail_queries > 0:
+        string += f' ({round(100 * (1 - queries / per_trail_queries), 2)}% fewer)'
+
+    return string
+
+def filter_right_pair_candidates(round_num, ciphertexts1, ciphertexts2, output_xor, round_keys):
+    """
+    For a right pair, the partially decrypted XOR has to be zero in every
+    SBOX which is inactive in output_xor, no matter the key guess. This
+    function throws away all pairs for which that isn't the case.
+
+    With DDT_FILTER, it also throws away pairs where an active SBOX could
+    never turn its nibble of output_xor into the XOR of the pair (the key
+    doesn't change the XOR going into an SBOX).
+
+    Returns the surviving pairs partially decrypted through the known rounds
+    (see partially_decrypt_known_rounds), so they don't have to be decrypted
+    again, in this form:
+
+    (states1, states2)
+    """
+
+    inactive_mask = 0xffff & ~find_which_key_bits_will_be_broken(3, output_xor)
+
+    possible_xors = get_possible_xors(output_xor) if DDT_FILTER else None
+
+    if np is not None:
+        states1 = partially_decrypt_known_rounds(round_num, np.asarray(ciphertexts1, dtype=np.uint16), round_keys)
+        states2 = partially_decrypt_known_rounds(round_num, np.asarray(ciphertexts2, dtype=np.uint16), round_keys)
+
+        xors = states1 ^ states2
+
+        survivors = (xors & inactive_mask) == 0
+
+        if possible_xors is not None:
+            for i in range(4):
+                survivors &= possible_xors[i][(xors >> (4 * i)) & 0xf]
+
+        record_pair_filter_stats(len(ciphertexts1), int(survivors.sum()))
+
+        return (states1[survivors], states2[survivors])
+
+    new_states1 = []
+    new_states2 = []
+
+    for text1, text2 in zip(ciphertexts1, ciphertexts2):
+        state1 = partially_decrypt_known_rounds(round_num, text1, round_keys)
+        state2 = partially_decrypt_known_rounds(round_num, text2, round_keys)
+
+        xor = state1 ^ state2
+
+        if xor & inactive_mask != 0: continue
+
+        if possible_xors is not None and not all(possible_xors[i][get_nibble(xor, i)] for i in range(4)): continue
+
+        new_states1.append(state1)
+        new_states2.append(state2)
+
+    record_pair_filter_stats(len(ciphertexts1), len(new_states1))
+
+    return (new_states1, new_states2)
+
+def get_possible_xors(output_xor):
+    """
+    Returns a list with a table for every SBOX: possible_xors[i][x] is True
+    if nibble x is a possible XOR after SBOX i, given its input XOR from
+    output_xor. With NumPy, the tables are boolean arrays.
+
+    They only depend on output_xor, so they're only built once for every
+    output_xor.
+    """
+
+    if output_xor in POSSIBLE_XORS:
+        return POSSIBLE_XORS[output_xor]
+
+    diff_dist_table = build_difference_distribution_table(SBOX)
+
+    possible_xors = [[diff_dist_table[get_nibble(output_xor, i)][x] > 0 for x in range(16)] for i in range(4)]
+
+    if np is not None:
+        possible_xors = [np.array(table) for table in possible_xors]
+
+    POSSIBLE_XORS[output_xor] = possible_xors
+
+    return possible_xors
+
+def use_ddt_filter():
+    global DDT_FILTER
+
+    DDT_FILTER = True
+
+def record_pair_filter_stats(num_pairs, num_survived):
+    PAIR_FILTER_STATS['pairs'] += num_pairs
+    PAIR_FILTER_STATS['survived'] += num_survived
+
+def get_pair_filter_stats_string():
+    pairs = PAIR_FILTER_STATS['pairs']
+    survived = PAIR_FILTER_STATS['survived']
+
+    percentage = round(100 * survived / pairs, 2) if pairs > 0 else 0
+
+    return f'Right pair filter: {survived} of {pairs} pairs survived ({percentage}%)'
+
+def map_over_pair_chunks(function, round_num, states1, states2, weights, *args, parallel=True):
+    """
+    Splits the pairs of states (and their weights, see compress_pairs) into
+    one consecutive chunk per worker and calls function(round_num, chunk1,
+    chunk2, chunk_weights, *args) on every chunk, in the worker pool if
+    there are workers. If parallel is False, function is called once on all
+    pairs in this process instead.
+
+    Returns the results in chunk order, so that reducing them gives the
+    same answer regardless of the number of workers.
+    """
+
+    num_workers = NUM_WORKERS if parallel else 1
+
+    chunk_size = max(1, math.ceil(len(states1) / num_workers))
+
+    chunks = []
+
+    # There is always at least one (maybe empty) chunk, so that there is
+    # something to reduce even when no pairs survived filtering
+    for start in range(0, max(1, len(states1)), chunk_size):
+        chunks.append((states1[start:start + chunk_size], states2[start:start + chunk_size], weights[start:start + chunk_size]))
+
+    if num_workers == 1:
+        return [function(round_num, chunk1, chunk2, chunk_weights, *args) for chunk1, chunk2, chunk_weights in chunks]
+
+    worker_pool = get_worker_pool()
+
+    futures = [worker_pool.submit(function, round_num, chunk1, chunk2, chunk_weights, *args) for chunk1, chunk2, chunk_weights in chunks]
+
+    return [future.result() for future in futures]
+
+def use_worker_pool(num_workers):
+    """
+    Makes map_over_pair_chunks count big enough counts with num_workers
+    worker processes. The pool itself is only started when it's first
+    needed (see get_worker_pool).
+    """
+
+    global NUM_WORKERS
+
+    NUM_WORKERS = num_workers
+
+def get_worker_pool():
+    """
+    Returns the process pool used by map_over_pair_chunks, starting it the
+    first time. Every worker compiles its own copy of the cipher tables.
+    """
+
+    global WORKER_POOL
+
+    if WORKER_POOL is None:
+        WORKER_POOL = concurrent.futures.ProcessPoolExecutor(NUM_WORKERS, initializer=compile_cipher)
+
+    return WORKER_POOL
+
+def guess_key_bits_for_pairs(round_num, states1, states2, weights, output_xor, breaking_key_bits):
+    """
+    Calls guess_key_bits for every pair of partially decrypted states, with
+    its weight (see compress_pairs). Returns the resulting key counts (see
+    new_key_counts).
+    """
+
+    key_counts = new_key_counts(breaking_key_bits)
+
+    for state1, state2, weight in zip(states1, states2, weights):
+        guess_key_bits(round_num, int(state1), int(state2), output_xor, key_counts, breaking_key_bits, weight)
+
+    return key_counts
+
+def guess_key_bits(round_num, state1, state2, output_xor, key_counts, breaking_key_bits, weight=1):
+    """
+    For a given pair of ciphertexts, already partially decrypted through
+    the known rounds (see partially_decrypt_known_rounds), this function
+    goes through every possible key bit combination (specified by
+    breaking_key_bits). It returns nothing.
+    Instead, it increments the entry of the key guess in key_counts (see
+    new_key_counts) whenever the highly-likely output XOR matches the XOR of
+    the partially decrypted ciphertexts. The counts are incremented by
+    weight, the number of pairs this pair stands for.
+
+    The key guesses come in Gray code order (see iterate_key_guesses), so
+    from one guess to the next only the SBOX whose key bit flipped has to be
+    decrypted again.
+    """
+
+    permuted = round_num + 1 < 4
+
+    # The guessed key moved past the inverse permutation, like the states
+    # (see partially_decrypt_known_rounds)
+    moved_key_guess = 0
+
+    partial_xor = INV_SUB_TABLE[state1] ^ INV_SUB_TABLE[state2]
+
+    for key_guess_index, key_guess_bits, flipped_bit in iterate_key_guesses(breaking_key_bits):
+        if flipped_bit is not None:
+            moved_bit = INV_PERM_TABLE[1 << flipped_bit] if permuted else 1 << flipped_bit
+            moved_key_guess ^= moved_bit
+
+            shift = 4 * ((moved_bit.bit_length() - 1) // 4)
+
+            nibble1 = ((state1 ^ moved_key_guess) >> shift) & 0xf
+            nibble2 = ((state2 ^ moved_key_guess) >> shift) & 0xf
+
+            partial_xor = (partial_xor & ~(0xf << shift)) | ((INV_SBOX[nibble1] ^ INV_SBOX[nibble2]) << shift)
+
+        if partial_xor == output_xor:
+            key_counts[key_guess_index] += weight
+
+def iterate_key_guesses(breaking_key_bits):
+    """
+    Iterates over every possible key guess for the bits set in
+    breaking_key_bits in Gray code order, so that consecutive guesses only
+    differ in one bit. Yields tuples in this form:
+
+    (key_guess_index, key_guess_bits, flipped_bit)
+
+    where key_guess_index is the compressed key guess (its index in key
+    counts, see new_key_counts) and flipped_bit is the position of the bit
+    that changed since the previous guess, or None for the first guess
+    (which is always 0).
+    """
+
+    key_guesses = get_key_guesses(breaking_key_bits)
+    mask_bits = [j for j in range(16) if get_bit(breaking_key_bits, j) == 1]
+
+    yield (0, key_guesses[0], None)
+
+    for i in range(1, len(key_guesses)):
+        # The Gray code of i differs from the one of i - 1 in the lowest
+        # set bit of i
+        key_guess_index = i ^ (i >> 1)
+
+        yield (key_guess_index, key_guesses[key_guess_index], mask_bits[(i & -i).bit_length() - 1])
+
+def get_key_guesses(breaking_key_bits):
+    """
+    Returns the bit-deposit table of breaking_key_bits: a list of every key
+    guess for the bits set in it, indexed by the compressed key guess. The
+    i-th key guess has the bits of i scattered, in order, over the bits set
+    in breaking_key_bits (the lowest bit of i in the lowest bit of the
+    mask). It's only built once for every mask.
+    """
+
+    if breaking_key_bits in KEY_GUESS_TABLES:
+        return KEY_GUESS_TABLES[breaking_key_bits]
+
+    key_guesses = [0]
+
+    # Every bit of the mask doubles the table: the guesses so far without
+    # that bit, then with it
+    for j in range(16):
+        if get_bit(breaking_key_bits, j) == 1:
+            key_guesses += [k | (1 << j) for k in key_guesses]
+
+    KEY_GUESS_TABLES[breaking_key_bits] = key_guesses
+
+    return key_guesses
+
+def count_key_guesses(round_num, states1, states2, weights, output_xor, breaking_key_bits):
+    """
+    Vectorized version of calling guess_key_bits for every pair of
+    partially decrypted states with its weight. Only the active SBOXes are
+    checked, so the pairs have to have passed filter_right_pair_candidates.
+
+    Returns the key counts (see new_key_counts) of how many pairs partially
+    decrypt to output_xor under every key guess.
+    """
+
+    permuted = round_num + 1 < 4
+
+    active_nibbles = [i for i in range(4) if get_nibble(output_xor, i) != 0]
+
+    weights = np.asarray(weights, dtype=np.int64)
+
+    # Counts over every combination of key nibbles for the active SBOXes,
+    # with the first active nibble as the most significant digit
+    nibble_counts = np.zeros(16 ** len(active_nibbles), dtype=np.int64)
+
+    # Bound memory of the pairs x guesses matrix
+    chunk_size = max(1, (1 << 22) // len(nibble_counts))
+
+    for start in range(0, len(states1), chunk_size):
+        chunk1 = states1[start:start + chunk_size]
+        chunk2 = states2[start:start + chunk_size]
+        chunk_weights = weights[start:start + chunk_size]
+
+        matches = np.ones((len(chunk1), 1), dtype=bool)
+
+        for i in active_nibbles:
+            nibbles1 = (chunk1 >> (4 * i)) & 0xf
+            nibbles2 = (chunk2 >> (4 * i)) & 0xf
+
+            # nibble_matches[p][g] is True if pair p matches with key nibble g
+            nibble_matches = INV_SBOX_DIFF_ARRAY[nibbles1, nibbles2] == get_nibble(output_xor, i)
+
+            matches = (matches[:, :, None] & nibble_matches[:, None, :]).reshape(len(chunk1), -1)
+
+        # Integer matrix products are slow in NumPy. Floats count exactly as
+        # long as the counts stay below 2^24 (or 2^53 for doubles)
+        dtype = np.float32 if chunk_weights.sum() < 1 << 24 else np.float64
+
+        nibble_counts += (chunk_weights.astype(dtype) @ matches.astype(dtype)).astype(np.int64)
+
+    # Reorder from key nibbles to compressed key guesses
+    return nibble_counts[get_key_guess_order(breaking_key_bits, active_nibbles, permuted)]
+
+def get_key_guess_order(breaking_key_bits, active_nibbles, permuted):
+    """
+    Returns an index array which reorders the counts of count_key_guesses
+    from combinations of key nibbles to compressed key guesses. It's the
+    same for every call with the same trail, so it's only built once.
+    """
+
+    cache_key = (breaking_key_bits, tuple(active_nibbles), permuted)
+
+    if cache_key in KEY_GUESS_ORDERS:
+        return KEY_GUESS_ORDERS[cache_key]
+
+    key_guesses = get_key_guesses(breaking_key_bits)
+
+    order = np.zeros(len(key_guesses), dtype=np.int64)
+
+    for i, key_guess_bits in enumerate(key_guesses):
+        if permuted:
+            key_guess_bits = permutate(key_guess_bits, INV_PBOX)
+
+        index = 0
+
+        for j in active_nibbles:
+            index = index * 16 + get_nibble(key_guess_bits, j)
+
+        order[i] = index
+
+    KEY_GUESS_ORDERS[cache_key] = order
+
+    return order
+
+def partially_decrypt_known_rounds(round_num, states, round_keys):
+    """
+    Partially decrypts states with the round keys we already know, so we're
+    left right before the xor with the key we're guessing (the round key
+    after round_num).
+
+    If that key is followed by the inverse permutation, it is applied as
+    well. It is linear, so INV_PBOX(state ^ key) is equal to
+    INV_PBOX(state) ^ INV_PBOX(key). After moving the key past it, every
+    nibble of the result belongs to one SBOX.
+
+    Works on a single state, or on a NumPy array of states. Every state is
+    counted in ATTACK_STATS as a partial decryption.
+    """
+
+    batch = np is not None and isinstance(states, np.ndarray)
+
+    ATTACK_STATS['partial_decryptions'] += len(states) if batch else 1
+
+    for i in range(4, round_num + 1, -1):
+        if batch:
+            table = INV_ROUND_ARRAY if i < 4 else INV_SUB_ARRAY
+        else:
+            table = INV_ROUND_TABLE if i < 4 else INV_SUB_TABLE
+
+        states = table[states ^ round_keys[i]]
+
+    if round_num + 1 < 4:
+        states = INV_PERM_ARRAY[states] if batch else INV_PERM_TABLE[states]
+
+    return states
+
+def get_most_probable_keys(key_counts, breaking_key_bits):
+    """
+    Given the counts from count_key_bits, returns the (at most) MIN_OPTIONS
+    key guesses with the most matches, in the order of their probability.
+    Guesses with no matches are never returned. Ties go to the smallest
+    key guess.
+    """
+
+    key_guesses = get_key_guesses(breaking_key_bits)
+
+    return [key_guesses[i] for i in get_top_key_guesses(key_counts, MIN_OPTIONS) if key_counts[i] > 0]
+
+def break_first_round_keys(round_keys, second_round_keys):
+    """
+    For the first key, we don't need anything special. Just decrypt a known
+    ciphertext (see get_known_pairs) all the way to the key with the keys
+    we've already broken and then XOR that value with the original
+    plaintext.
+
+    round_keys holds KEY3 to KEY5, and second_round_keys is a list of
+    candidates for KEY2. Returns the full 5 key combination for every
+    candidate.
+    """
+
+    with time_stage('break KEY1'):
+        plaintext, ciphertext = get_known_pairs()[0]
+
+        # Decrypt ciphertext all the way to last xor with the round_keys we found.
+        # Decrypting with a zero KEY1 leaves out that last xor
+        if np is not None:
+            keys2 = np.array(second_round_keys, dtype=np.uint16)
+
+            decryptions = decrypt_batch(np.full(len(keys2), ciphertext, dtype=np.uint16), 0, keys2, round_keys[2], round_keys[3], round_keys[4]).tolist()
+        else:
+            decryptions = [fast_decrypt(ciphertext, 0, k2, round_keys[2], round_keys[3], round_keys[4]) for k2 in second_round_keys]
+
+    # Get the last key
+    return [[plaintext ^ decryption, k2, round_keys[2], round_keys[3], round_keys[4]] for k2, decryption in zip(second_round_keys, decryptions)]
+
+def partial_decryption(round_num, ciphertext1, ciphertext2, round_keys):
+    """
+    This function partially decrypts ciphertext1 and ciphertext2 using
+    round_keys up to round_num. It returns their XOR after partial decryption.
+    """
+
+    for i in range(4, round_num, -1):
+        ciphertext1 = add_round_key(ciphertext1, round_keys[i])
+        ciphertext2 = add_round_key(ciphertext2, round_keys[i])
+
+        if i < 4:
+            ciphertext1 = permutate(ciphertext1, INV_PBOX)
+            ciphertext2 = permutate(ciphertext2, INV_PBOX)
+
+        ciphertext1 = substitute(ciphertext1, INV_SBOX)
+        ciphertext2 = substitute(ciphertext2, INV_SBOX)
+
+    partial_xor = ciphertext1 ^ ciphertext2
+        
+    return partial_xor
+
+def find_which_key_bits_will_be_broken(round_num, output_xor):
+    """
+    In order to guess key bits we need to know which bits to guess. This
+    function returns a bit string with 1 bits representing bits which we're
+    attempting to break given the output_xor and round_num.
+    """
+
+    breaking_key_bits = 0
+
+    for i in range(4):
+        if get_nibble(output_xor, i) != 0:
+            breaking_key_bits = set_nibble(breaking_key_bits, i, 0xf)
+
+    if round_num < 3: # If round_num < 3 we need to take the permutation into account
+        breaking_key_bits = permutate(breaking_key_bits, PBOX)
+        
+    return breaking_key_bits
+
+def find_differential_trails_to_break_full_key(round_num, most_probable_diff_trails):
+    """
+    Finds the combination of diff trails which together break the full key,
+    i.e. every SBOX is active at the end of at least one of them, at the
+    lowest predicted cost (see get_trail_cost).
+
+    This is a set cover, but a tiny one. Trails with the same final active
+    SBOXes break the same key bits, so only the cheapest of them can be part
+    of the cheapest combination. That leaves at most 15 candidates, one for
+    every set of SBOXes, and the cheapest cover of every set of SBOXes is
+    found exactly, one candidate at a time.
+
+    The trails are returned from the most to the least probable. Where two
+    of them break the same key bits, break_round_key keeps the bits of the
+    first one.
+    """
+
+    candidates = {}
+
+    for diff_trail in most_probable_diff_trails:
+        probability = diff_trail[1]
+        output_xor = diff_trail[3]
+
+        if probability <= 0: continue
+
+        sboxes = get_final_active_sboxes(output_xor)
+        cost = get_trail_cost(probability, output_xor)
+
+        if sboxes not in candidates or cost < candidates[sboxes][0]:
+            candidates[sboxes] = (cost, diff_trail)
+
+    # covers[sboxes] is the cheapest combination found so far whose final
+    # active SBOXes are exactly sboxes, in this form: (cost, diff_trails)
+    covers = {0: (0, [])}
+
+    for sboxes, (cost, diff_trail) in sorted(candidates.items()):
+        for covered_sboxes, (cover_cost, diff_trails) in list(covers.items()):
+            new_sboxes = covered_sboxes | sboxes
+            new_cost = cover_cost + cost
+
+            if new_sboxes not in covers or new_cost < covers[new_sboxes][0]:
+                covers[new_sboxes] = (new_cost, diff_trails + [diff_trail])
+
+    if 0xf not in covers:
+        raise ValueError(f'No differential trails of round {round_num} cover every SBOX')
+
+    return sorted(covers[0xf][1], key=lambda diff_trail: diff_trail[1], reverse=True)
+
+def get_final_active_sboxes(output_xor):
+    """
+    Returns a bit string with the i-th bit set if the i-th SBOX is active,
+    i.e. the i-th nibble of output_xor is nonzero.
+    """
+
+    return sum(1 << i for i in range(4) if get_nibble(output_xor, i) != 0)
+
+def get_trail_cost(probability, output_xor):
+    """
+    Predicts what breaking the key bits of a trail costs (see break_key_bits).
+
+    It chooses round(C / probability) pairs, which are 2 oracle queries
+    each. Pairs only get key guesses if the inactive SBOXes of both
+    ciphertexts agree (see filter_right_pair_candidates), which right pairs
+    always do and a random pair does with probability 2^(bits - 16). The
+    pairs which do are compressed into at most 2^(2 * bits) histogram bins
+    (see compress_pairs), and every bin gets 2^bits key guesses. bits is the
+    number of key bits the trail breaks.
+    """
+
+    num_pairs = round(C / probability)
+    num_bits = 4 * count_one_bits(get_final_active_sboxes(output_xor))
+
+    num_counted = num_pairs * min(1, probability + 2 ** (num_bits - 16))
+    num_bins = min(num_counted, 2 ** (2 * num_bits))
+
+    return QUERY_COST * 2 * num_pairs + KEY_GUESS_COST * num_bins * 2 ** num_bits
+
+def find_highly_probable_differential_trails(diff_dist_table, round_num):
+    """
+    Finds a highly probable differential trails for every possible input XOR,
+    with the help of the find_differential_trail function.
+
+    Returns a list of differential trails in this form:
+
+    (preference, input_xor, output_xor)
+    """
+
+    differential_trails = []
+
+    for i in range(16):
+        for j in range(16):
+            for k in range(16):
+                for l in range(16):
+
+                    if i == 0 and j == 0 and k == 0 and l == 0: continue # We don't care about all zero xors
+
+                    input_xor = 0
+
+                    input_xor = set_nibble(input_xor, 0, l)
+                    input_xor = set_nibble(input_xor, 1, k)
+                    input_xor = set_nibble(input_xor, 2, j)
+                    input_xor = set_nibble(input_xor, 3, i)
+
+                    output_xor, probability, preference = find_differential_trail(input_xor, diff_dist_table, round_num)
+
+                    differential_trails.append((preference, probability, input_xor, output_xor))
+
+    differential_trails.sort(reverse=True)
+
+    return differential_trails
+
+def find_highly_probable_differential_trails_for_all_rounds(diff_dist_table, max_round_num):
+    """
+    Same as calling find_highly_probable_differential_trails for every
+    round_num from 0 up to max_round_num, but all in one pass.
+
+    Since find_differential_trail is greedy, one round always takes an XOR
+    to the same next XOR with the same probability. So we compute that step
+    once for all 2^16 XORs, and every round's trails are just the previous
+    round's trails taken one step further.
+
+    Returns a list with the differential trails for every round_num, each in
+    the same form as find_highly_probable_differential_trails.
+    """
+
+    if np is None:
+        return [find_highly_probable_differential_trails(diff_dist_table, r) for r in range(max_round_num + 1)]
+
+    table = np.array(diff_dist_table)
+
+    # Most probable output XOR (the first one, like list.index) and its
+    # count for every SBOX input XOR
+    best_outputs = table.argmax(axis=1)
+    best_counts = table.max(axis=1)
+
+    all_xors = np.arange(0x10000)
+
+    # One greedy round for every XOR. The zero nibbles of inactive SBOXes
+    # stay zero with probability 1
+    substituted = np.zeros(0x10000, dtype=np.int64)
+    step_probabilities = np.ones(0x10000, dtype=np.float64)
+
+    for i in range(4):
+        nibbles = (all_xors >> (4 * i)) & 0xf
+
+        substituted |= best_outputs[nibbles] << (4 * i)
+        step_probabilities *= best_counts[nibbles] / 16
+
+    step_xors = PERM_ARRAY[substituted]
+
+    input_xors = all_xors[1:] # We don't care about all zero xors
+    output_xors = input_xors
+    probabilities = np.ones(len(input_xors), dtype=np.float64)
+
+    all_differential_trails = []
+
+    for r in range(max_round_num + 1):
+        if r > 0:
+            probabilities = probabilities * step_probabilities[output_xors]
+            output_xors = step_xors[output_xors]
+
+        num_final_active_sboxes = np.zeros(len(output_xors), dtype=np.int64)
+
+        for i in range(4):
+            num_final_active_sboxes += ((output_xors >> (4 * i)) & 0xf) != 0
+
+        # Same as get_trail_preference
+        preferences = probabilities.copy()
+        preferences[num_final_active_sboxes == 3] /= 4
+        preferences[num_final_active_sboxes == 4] = 0
+
+        order = np.lexsort((output_xors, input_xors, probabilities, preferences))[::-1]
+
+        differential_trails = list(zip(preferences[order].tolist(), probabilities[order].tolist(),
+                                       input_xors[order].tolist(), output_xors[order].tolist()))
+
+        all_differential_trails.append(differential_trails)
+
+    return all_differential_trails
+
+def find_differential_trail(input_xor, diff_dist_table, round_num):
+    """
+    Greedily finds a highly probable differential trail of length round_num
+    with a certain input XOR. Note that because it's greedy (always takes the
+    most likely SBOX output XOR) it's not necessarily the most probable.
+
+    Returns the final XOR, the trail's raw probability, and its "preference"
+    which depends on the final number of active SBOXes in this form:
+
+    (final_xor, probability, preference)
+    """
+
+    probability = 1
+
+    current_xor = input_xor
+
+    for r in range(round_num):
+        # XOR doesn't change over key addition, so we can just ignore it
+
+        # XOR going through sbox changes the probability (non-linear)
+        for i in range(4):
+            if get_nibble(current_xor, i) > 0: # SBOX is active
+
+                # Get max entry in diff_dist row and adjust probability based on that
+                max_count = max(diff_dist_table[get_nibble(current_xor, i)])
+                most_probable_output_xor = diff_dist_table[get_nibble(current_xor, i)].index(max_count)
+
+                probability *= max_count / 16
+
+                current_xor = set_nibble(current_xor, i, most_probable_output_xor)
+
+        # XOR changes over permutation, but the probability is not affected (linear)
+        current_xor = permutate(current_xor, PBOX)
+
+
+    preference = get_trail_preference(probability, current_xor)
+
+    return (current_xor, probability, preference)
+
+def get_trail_preference(probability, final_xor):
+    """
+    If we get a highly probable trail which has all the final SBOXes active,
+    we'll have to break a whole round key at once. It's much better to find
+    a trail with few final SBOXes active so we can break smaller portions of
+    the round key at a time. This is why we assign a "preference" to each
+    trail which is a function of the trail's probability and its number of
+    final active SBOXes.
+
+    The preference only orders the trail tables. Which trails are actually
+    used is decided by their predicted cost, see
+    find_differential_trails_to_break_full_key.
+    """
+
+    num_final_active_sboxes = 0
+    
+    for i in range(4):
+        if get_nibble(final_xor, i) > 0:
+            num_final_active_sboxes += 1
+
+    preference = probability
+
+    # 1 active SBOX: perfect
+    # 2 active SBOXes: the key bits are broken within a couple of seconds. We 
+    #                  won't adjust preference since it's fast enough and only
+    #                  1 active SBOX is not likely anyway
+    # 3 active SBOXes: could take longer sec so divide preference by some
+    #                  constant to discourage using it.
+    # 4 active SBOXes: will take a very long time so we never want to use them. 
+    #                  We set preference to zero so we'll try to find 
+    #                  alternatives with fewer active sboxes
+
+    if num_final_active_sboxes == 3: preference /= 4
+    if num_final_active_sboxes == 4: preference = 0
+
+    return preference
+
+def find_optimal_differential_trails(diff_dist_table, round_num):
+    """
+    Like find_highly_probable_differential_trails, but instead of a greedy
+    trail for every input XOR, it finds the provably most probable trail for
+    every combination of final active SBOXes with the help of the
+    find_optimal_differential_trail function.
+
+    Returns a list of differential trails in the same form:
+
+    (preference, probability, input_xor, output_xor)
+    """
+
+    differential_trails = []
+
+    # Optimal probabilities for fewer rounds are used as pruning bounds
+    best_probabilities = find_optimal_trail_probabilities(diff_dist_table, round_num - 1)
+
+    for pattern in range(1, 16):
+        final_active_sboxes = [get_bit(pattern, i) == 1 for i in range(4)]
+
+        trail = find_optimal_differential_trail(diff_dist_table, round_num, final_active_sboxes, best_probabilities)
+
+        if trail is None: continue # No trail ends in exactly these SBOXes
+
+        input_xor, output_xor, probability = trail
+        preference = get_trail_preference(probability, output_xor)
+
+        differential_trails.append((preference, probability, input_xor, output_xor))
+
+    differential_trails.sort(reverse=True)
+
+    return differential_trails
+
+def find_optimal_trail_probabilities(diff_dist_table, round_num):
+    """
+    Returns a list with the probability of the most probable differential
+    trail of every length from 0 up to round_num, without any constraint on
+    the final active SBOXes. Each one is used to bound the search for the
+    next one.
+    """
+
+    best_probabilities = [1]
+
+    for r in range(1, round_num + 1):
+        trail = find_optimal_differential_trail(diff_dist_table, r, None, best_probabilities)
+
+        best_probabilities.append(trail[2])
+
+    return best_probabilities
+
+def find_optimal_differential_trail(diff_dist_table, round_num, final_active_sboxes=None, best_probabilities=None):
+    """
+    Finds the most probable differential trail of length round_num with a
+    Matsui-style branch-and-bound search. Unlike find_differential_trail,
+    the input XOR is not fixed: the search goes through every input XOR.
+
+    If final_active_sboxes (a list of 4 booleans, like sboxes_already_used)
+    is given, only trails whose final XOR has exactly those SBOXes active
+    are considered.
+
+    best_probabilities[r] should be the probability of the most probable
+    r-round trail (see find_optimal_trail_probabilities). It is used to
+    prune partial trails that can't beat the best trail found so far, and
+    is computed when not given.
+
+    Returns the trail in this form, or None if there is no such trail:
+
+    (input_xor, output_xor, probability)
+    """
+
+    if best_probabilities is None:
+        best_probabilities = find_optimal_trail_probabilities(diff_dist_table, round_num - 1)
+
+    # A zero round trail always holds, so just pick any XOR ending in the
+    # right SBOXes
+    if round_num == 0:
+        final_xor = 0
+
+        for i in range(4):
+            if final_active_sboxes is None or final_active_sboxes[i]:
+                final_xor = set_nibble(final_xor, i, 0xf)
+
+        return (final_xor, final_xor, 1)
+
+    # Possible SBOX output XORs for each input XOR, most probable first
+    transitions = [[] for a in range(16)]
+
+    for a in range(1, 16):
+        for b in range(16):
+            if diff_dist_table[a][b] > 0:
+                transitions[a].append((diff_dist_table[a][b] / 16, b))
+
+        transitions[a].sort(reverse=True)
+
+    # In the first round the input XOR is free, so every SBOX can take any
+    # transition or stay inactive (which has probability 1)
+    first_round_transitions = [(1, 0, 0)]
+
+    for a in range(1, 16):
+        for probability, b in transitions[a]:
+            first_round_transitions.append((probability, a, b))
+
+    first_round_transitions.sort(reverse=True)
+
+    max_sbox_probability = max(t[0][0] for t in transitions[1:])
+
+    # permuted_nibbles[i][b] is where output XOR b of SBOX i ends up after
+    # the permutation. final_masks[i][b] is which final SBOXes it activates
+    permuted_nibbles = [[permutate(b << (4 * i), PBOX) for b in range(16)] for i in range(4)]
+    final_masks = [[find_which_key_bits_will_be_broken(3, x) for x in row] for row in permuted_nibbles]
+
+    allowed_final_mask = 0xffff
+
+    if final_active_sboxes is not None:
+        allowed_final_mask = 0
+
+        for i in range(4):
+            if final_active_sboxes[i]:
+                allowed_final_mask = set_nibble(allowed_final_mask, i, 0xf)
+
+    best_trail = None
+    best_probability = 0
+
+    def search_sbox(r, i, input_xor, round_input_xor, round_output_xor, probability):
+        nonlocal best_trail, best_probability
+
+        if i == 4:
+            if round_input_xor == 0: return # We don't care about all zero xors
+
+            next_xor = 0
+
+            for j in range(4):
+                next_xor |= permuted_nibbles[j][get_nibble(round_output_xor, j)]
+
+            if r == 1:
+                input_xor = round_input_xor
+
+            if r == round_num:
+                final_mask = find_which_key_bits_will_be_broken(3, next_xor)
+
+                if final_active_sboxes is not None and final_mask != allowed_final_mask: return
+
+                if probability > best_probability:
+                    best_probability = probability
+                    best_trail = (input_xor, next_xor, probability)
+
+                return
+
+            search_round(r + 1, input_xor, next_xor, probability)
+
+            return
+
+        # Bound the rest of this round by the best possible probability of
+        # each remaining active SBOX, and the remaining rounds by the best
+        # trail of that length
+        bound = probability * best_probabilities[round_num - r]
+
+        if r > 1:
+            for j in range(i + 1, 4):
+                if get_nibble(round_input_xor, j) != 0:
+                    bound *= max_sbox_probability
+
+        if bound <= best_probability: return
+
+        if r == 1:
+            options = first_round_transitions
+        elif get_nibble(round_input_xor, i) == 0:
+            options = [(1, 0, 0)]
+        else:
+            a = get_nibble(round_input_xor, i)
+            options = [(p, a, b) for p, b in transitions[a]]
+
+        for sbox_probability, a, b in options:
+            # Options are ordered, so none of the rest can beat the best trail
+            if bound * sbox_probability <= best_probability: break
+
+            # In the last round, the output XOR can't reach disallowed SBOXes
+            if r == round_num and final_masks[i][b] & ~allowed_final_mask: continue
+
+            search_sbox(r, i + 1, input_xor,
+                        set_nibble(round_input_xor, i, a),
+                        set_nibble(round_output_xor, i, b),
+                        probability * sbox_probability)
+
+    def search_round(r, input_xor, round_input_xor, probability):
+        search_sbox(r, 0, input_xor, round_input_xor, 0, probability)
+
+    search_round(1, 0, 0, 1)
+
+    return best_trail
+
+def use_differential_probabilities(diff_dist_table, round_num, diff_trails):
+    """
+    A trail's probability only counts pairs which follow that exact trail,
+    but any pair with the trail's input XOR and output XOR is a right pair
+    when breaking key bits, no matter which XORs it goes through in the
+    middle. Many trails cluster into the same differential, so its
+    probability is higher and we need fewer chosen plaintexts.
+
+    Returns the differential trails, in the same order, with their
+    probability replaced by the exact differential probability (and the
+    preference updated to match).
+    """
+
+    new_diff_trails = []
+
+    for preference, probability, input_xor, output_xor in diff_trails:
+        probability = find_differential_probability(diff_dist_table, input_xor, output_xor, round_num)
+        preference = get_trail_preference(probability, output_xor)
+
+        new_diff_trails.append((preference, probability, input_xor, output_xor))
+
+    return new_diff_trails
+
+def find_differential_probability(diff_dist_table, input_xor, output_xor, round_num):
+    """
+    Returns the exact probability that input_xor becomes output_xor after
+    round_num rounds, summed over every trail in between. Like all the
+    probabilities in this script, it assumes independent round keys.
+    """
+
+    distribution = find_output_xor_distribution(diff_dist_table, input_xor, round_num)
+
+    if np is not None:
+        return float(distribution[output_xor])
+
+    return distribution.get(output_xor, 0)
+
+def find_most_probable_output_xors(diff_dist_table, input_xor, round_num, num_output_xors):
+    """
+    Returns the num_output_xors most probable output XORs of input_xor
+    after round_num rounds in this form:
+
+    [(probability, output_xor), ...]
+    """
+
+    distribution = find_output_xor_distribution(diff_dist_table, input_xor, round_num)
+
+    if np is not None:
+        output_xors = np.argsort(-distribution, kind='stable')[:num_output_xors]
+
+        return [(float(distribution[x]), int(x)) for x in output_xors if distribution[x] > 0]
+
+    output_xors = sorted(distribution.items(), key=lambda x: (-x[1], x[0]))[:num_output_xors]
+
+    return [(probability, output_xor) for output_xor, probability in output_xors]
+
+def find_output_xor_distribution(diff_dist_table, input_xor, round_num):
+    """
+    Propagates input_xor through round_num rounds, keeping track of the
+    probability of every possible XOR instead of following a single trail.
+
+    Every round, the SBOX layer is applied one SBOX at a time, since each
+    SBOX only changes its own nibble of the XOR according to its row of the
+    difference distribution table. Then the XORs are permutated, which
+    doesn't change any probabilities.
+
+    With NumPy, returns an array of the probabilities of all 2^16 XORs.
+    Otherwise returns a dictionary with only the possible XORs.
+    """
+
+    if np is not None:
+        transition = np.array(diff_dist_table, dtype=np.float64) / 16
+
+        distribution = np.zeros(0x10000, dtype=np.float64)
+        distribution[input_xor] = 1
+
+        for r in range(round_num):
+            for i in range(4):
+                # Split every XOR into (higher nibbles, nibble i, lower nibbles)
+                distribution = distribution.reshape(16 ** (3 - i), 16, 16 ** i)
+                distribution = np.einsum('xay,ab->xby', distribution, transition)
+
+            distribution = distribution.reshape(0x10000)
+
+            permuted = np.empty_like(distribution)
+            permuted[PERM_ARRAY] = distribution
+
+            distribution = permuted
+
+        return distribution
+
+    distribution = {input_xor: 1}
+
+    for r in range(round_num):
+        for i in range(4):
+            new_distribution = {}
+
+            for current_xor, probability in distribution.items():
+                a = get_nibble(current_xor, i)
+
+                for b in range(16):
+                    if diff_dist_table[a][b] == 0: continue
+
+                    new_xor = set_nibble(current_xor, i, b)
+                    new_probability = probability * diff_dist_table[a][b] / 16
+
+                    new_distribution[new_xor] = new_distribution.get(new_xor, 0) + new_probability
+
+            distribution = new_distribution
+
+        distribution = {permutate(x, PBOX): probability for x, probability in distribution.items()}
+
+    return distribution
+
+def build_difference_distribution_table(sbox):
+    diff_dist_table = [[0 for i in range(len(sbox))] for j in range(len(sbox))]
+
+    for x_prime in range(16):
+        for x in range(16):
+            x_star = x ^ x_prime
+            y_prime = sbox[x] ^ sbox[x_star]
+
+            diff_dist_table[x_prime][y_prime] += 1
+
+    return diff_dist_table
+
+def choose_random_plaintext():
+    return random.randint(0, 0xffff)
+
+def choose_random_plaintexts(num):
+    """
+    Returns a uint16 NumPy array of num random plaintexts. The generator is
+    seeded from the random module so that random.seed() controls it as well.
+    """
+
+    rng = np.random.default_rng(random.getrandbits(64))
+
+    return rng.integers(0, 0x10000, size=num, dtype=np.uint16)
+
+
+
+""" --- ENCRYPTION ORACLE --- """
+
+def oracle_encrypt(plaintexts):
+    """
+    The chosen plaintext oracle: encrypts plaintexts under the secret keys.
+    This is the only way the attack is allowed to use KEY1 ... KEY5.
+
+    Takes and returns a uint16 NumPy array with NumPy and a list otherwise.
+    """
+
+    record_oracle_queries('encrypt', plaintexts)
+
+    return get_oracle().encrypt_many(plaintexts)
+
+def oracle_decrypt(ciphertexts):
+    """
+    The chosen ciphertext oracle: decrypts ciphertexts under the secret keys.
+
+    Takes and returns a uint16 NumPy array with NumPy and a list otherwise.
+    """
+
+    record_oracle_queries('decrypt', ciphertexts)
+
+    return get_oracle().decrypt_many(ciphertexts)
+
+def get_oracle():
+    global ORACLE
+
+    if ORACLE is None:
+        ORACLE = LocalOracle()
+
+    return ORACLE
+
+def use_oracle(oracle):
+    global ORACLE
+
+    ORACLE = oracle
+
+class LocalOracle:
+    """
+    Answers oracle queries in this process, with the codebook if it was
+    built and with the ORACLE_BACKEND cipher otherwise.
+
+    Every oracle has the same interface: encrypt_many and decrypt_many take
+    and return a batch of texts (a uint16 NumPy array with NumPy and a list
+    otherwise), and round_trips counts how many batches were asked for.
+    """
+
+    def __init__(self):
+        self.round_trips = 0
+
+    def encrypt_many(self, plaintexts):
+        self.round_trips += 1
+
+        return local_encrypt(plaintexts)
+
+    def decrypt_many(self, ciphertexts):
+        self.round_trips += 1
+
+        return local_decrypt(ciphertexts)
+
+class SocketOracle:
+    """
+    Answers oracle queries by asking an oracle server (see serve_oracle) in
+    another process, over a TCP or Unix socket.
+
+    Requests are made by an asyncio client running in a background thread.
+    Every batch is split into chunks which are spread over a pool of
+    connections, and all chunks on a connection are pipelined: they are all
+    sent without waiting for the answers, which are read as they come in.
+
+    The connections are opened by connect, or by the first query if it
+    wasn't called, and closed by close.
+    """
+
+    def __init__(self, address, num_connections=4, chunk_size=4096):
+        self.address = address
+        self.num_connections = num_connections
+        self.chunk_size = chunk_size
+
+        self.round_trips = 0
+        self.requests = 0
+
+        self.connections = None
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def encrypt_many(self, plaintexts):
+        return self.query(b'E', plaintexts)
+
+    def decrypt_many(self, ciphertexts):
+        return self.query(b'D', ciphertexts)
+
+    def connect(self):
+        asyncio.run_coroutine_threadsafe(self.connect_async(), self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.close_async(), self.loop).result()
+
+    def query(self, operation, texts):
+        self.round_trips += 1
+
+        future = asyncio.run_coroutine_threadsafe(self.query_async(operation, pack_texts(texts)), self.loop)
+
+        return unpack_texts(future.result())
+
+    async def connect_async(self):
+        if self.connections is not None:
+            return
+
+        # Only keep the pool once every connection is open, so a failed
+        # connection can't leave a partial pool behind
+        connections = []
+
+        try:
+            for i in range(self.num_connections):
+                connections.append(await open_oracle_connection(self.address))
+        except BaseException:
+            for reader, writer in connections:
+                writer.close()
+
+            raise
+
+        self.connections = connections
+
+    async def close_async(self):
+        if self.connections is None:
+            return
+
+        connections = self.connections
+        self.connections = None
+
+        for reader, writer in connections:
+            writer.close()
+
+        for reader, writer in connections:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass # Already closed by the server
+
+    async def query_async(self, operation, data):
+        await self.connect_async()
+
+        # Each text is 2 bytes
+        chunks = [data[i:i + 2 * self.chunk_size] for i in range(0, len(data), 2 * self.chunk_size)]
+
+        # Chunk k goes to connection k % num_connections
+        answers = await asyncio.gather(*(self.send_chunks(connection, operation, chunks[i::self.num_connections])
+                                         for i, connection in enumerate(self.connections)))
+
+        return b''.join(answers[k % self.num_connections][k // self.num_connections] for k in range(len(chunks)))
+
+    async def send_chunks(self, connection, operation, chunks):
+        reader, writer = connection
+
+        async def read_answers():
+            # The server answers the requests of a connection in order
+            return [await reader.readexactly(len(chunk)) for chunk in chunks]
+
+        # The answers have to be read while the requests are still being
+        # written. The server waits for every answer to be taken before it
+        # reads the next request, so once the chunks are bigger than the
+        # socket buffers, writing everything first would never finish
+        answers = asyncio.ensure_future(read_answers())
+
+        try:
+            for chunk in chunks:
+                writer.write(struct.pack('<cI', operation, len(chunk) // 2) + chunk)
+
+                await writer.drain()
+        except BaseException:
+            answers.cancel()
+            raise
+
+        self.requests += len(chunks)
+
+        return await answers
+
+def serve_oracle(address):
+    """
+    Runs an oracle server on address (see parse_oracle_address) which
+    answers queries with a LocalOracle until it is stopped.
+
+    Every request is an operation byte (b'E' to encrypt, b'D' to decrypt),
+    a little endian uint32 count and that many little endian uint16 texts.
+    The answer is the same number of uint16 texts.
+    """
+
+    oracle = LocalOracle()
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                operation, count = struct.unpack('<cI', await reader.readexactly(5))
+                texts = unpack_texts(await reader.readexactly(2 * count))
+
+                if operation == b'E':
+                    answers = oracle.encrypt_many(texts)
+                elif operation == b'D':
+                    answers = oracle.decrypt_many(texts)
+                else:
+                    break # Not a valid request
+
+                writer.write(pack_texts(answers))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # Client disconnected
+        finally:
+            writer.close()
+
+    async def run_server():
+        kind, location = parse_oracle_address(address)
+
+        if kind == 'unix':
+            server = await asyncio.start_unix_server(handle_connection, location)
+        else:
+            server = await asyncio.start_server(handle_connection, *location)
+
+        print(f'Serving the oracle on {address}', flush=True)
+
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run_server())
+    except KeyboardInterrupt:
+        pass
+
+async def open_oracle_connection(address):
+    kind, location = parse_oracle_address(address)
+
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(location)
+
+    return await asyncio.open_connection(*location)
+
+def parse_oracle_address(address):
+    """
+    Oracle addresses are either tcp:HOST:PORT or unix:PATH. Returns them in
+    this form:
+
+    ('tcp', (host, port)) or ('unix', path)
+    """
+
+    kind, _, location = address.partition(':')
+
+    if kind == 'unix' and location:
+        return ('unix', location)
+
+    if kind == 'tcp':
+        host, _, port = location.rpartition(':')
+
+        if host and port.isdigit():
+            return ('tcp', (host, int(port)))
+
+    raise ValueError(f'invalid oracle address {address!r}, should be tcp:HOST:PORT or unix:PATH')
+
+def pack_texts(texts):
+    if np is not None:
+        return np.asarray(texts, dtype='<u2').tobytes()
+
+    return struct.pack(f'<{len(texts)}H', *texts)
+
+def unpack_texts(data):
+    if np is not None:
+        return np.frombuffer(data, dtype='<u2').astype(np.uint16)
+
+    return list(struct.unpack(f'<{len(data) // 2}H', data))
+
+def local_encrypt(plaintexts):
+    if CODEBOOK is not None:
+        if np is not None:
+            return CODEBOOK[np.asarray(plaintexts, dtype=np.uint16)]
+
+        return [CODEBOOK[p] for p in plaintexts]
+
+    if ORACLE_BACKEND == 'bitsliced':
+        return encrypt_bitsliced(plaintexts, KEY1, KEY2, KEY3, KEY4, KEY5)
+
+    if np is not None:
+        return encrypt_batch(np.asarray(plaintexts, dtype=np.uint16), KEY1, KEY2, KEY3, KEY4, KEY5)
+
+    return [fast_encrypt(p, KEY1, KEY2, KEY3, KEY4, KEY5) for p in plaintexts]
+
+def local_decrypt(ciphertexts):
+    if INV_CODEBOOK is not None:
+        if np is not None:
+            return INV_CODEBOOK[np.asarray(ciphertexts, dtype=np.uint16)]
+
+        return [INV_CODEBOOK[c] for c in ciphertexts]
+
+    if ORACLE_BACKEND == 'bitsliced':
+        return decrypt_bitsliced(ciphertexts, KEY1, KEY2, KEY3, KEY4, KEY5)
+
+    if np is not None:
+        return decrypt_batch(np.asarray(ciphertexts, dtype=np.uint16), KEY1, KEY2, KEY3, KEY4, KEY5)
+
+    return [fast_decrypt(c, KEY1, KEY2, KEY3, KEY4, KEY5) for c in ciphertexts]
+
+def use_bitsliced_oracle():
+    global ORACLE_BACKEND
+
+    ORACLE_BACKEND = 'bitsliced'
+
+def build_codebook():
+    """
+    Since the block is only 16 bits, the whole codebook is 65536 entries.
+    This materializes it (and its inverse) once, after which the oracle
+    answers every query by indexing instead of encrypting.
+
+    Building the codebook is not counted as oracle queries. Only the queries
+    the attack actually issues are, see record_oracle_queries.
+    """
+
+    global CODEBOOK, INV_CODEBOOK
+
+    if np is not None:
+        all_states = np.arange(0x10000, dtype=np.uint16)
+
+        CODEBOOK = encrypt_batch(all_states, KEY1, KEY2, KEY3, KEY4, KEY5)
+        INV_CODEBOOK = np.empty_like(CODEBOOK)
+        INV_CODEBOOK[CODEBOOK] = all_states
+    else:
+        CODEBOOK = [fast_encrypt(p, KEY1, KEY2, KEY3, KEY4, KEY5) for p in range(0x10000)]
+        INV_CODEBOOK = [0] * 0x10000
+
+        for p, c in enumerate(CODEBOOK):
+            INV_CODEBOOK[c] = p
+
+def record_oracle_queries(kind, texts):
+    """
+    Counts the queries of the given kind ('encrypt' or 'decrypt') and marks
+    which distinct texts have been queried.
+    """
+
+    ORACLE_QUERIES[kind] += len(texts)
+
+    seen = ORACLE_SEEN[kind]
+
+    if np is not None:
+        np.frombuffer(seen, dtype=np.uint8)[np.asarray(texts, dtype=np.uint16)] = 1
+    else:
+        for text in texts:
+            seen[text] = 1
+
+def get_oracle_queries_string():
+    string = 'Oracle queries:'
+
+    for kind in ('encrypt', 'decrypt'):
+        distinct = ORACLE_SEEN[kind].count(1)
+
+        string += f'\n  {kind}: {ORACLE_QUERIES[kind]} ({distinct} distinct)'
+
+    oracle = get_oracle()
+
+    string += f'\n  round trips: {oracle.round_trips}'
+
+    if isinstance(oracle, SocketOracle):
+        string += f' ({oracle.requests} requests over {oracle.num_connections} connections)'
+
+    return string
+
+
+
+""" --- CACHE --- """
+
+# Bump this whenever the format or the contents of the cached files change
+CACHE_VERSION = 1
+
+# Cached trail tables are stored as flat binary records in this format.
+# The difference distribution table isn't cached, it's built in no time
+TRAIL_RECORD_FORMAT = '<ddHH' # (preference, probability, input_xor, output_xor)
+
+def get_differential_trails(diff_dist_table, trail_search, cache_dir):
+    """
+    Returns a list with the differential trails for every round_num from 0
+    to 3, found with the given trail_search ('optimal' or 'greedy'). They
+    are loaded from cache_dir if they were found before and found (and
+    cached) otherwise. No caching is done if cache_dir is None.
+    """
+
+    paths = [get_cache_path(cache_dir, trail_search + '-trails', r) for r in range(4)]
+
+    with time_stage('load cached trails'):
+        all_differential_trails = [load_cached_records(path, TRAIL_RECORD_FORMAT) for path in paths]
+
+    if None not in all_differential_trails:
+        return all_differential_trails
+
+    if trail_search == 'optimal':
+        all_differential_trails = []
+
+        for r in range(4):
+            with time_stage(f'trail search (round {r})'):
+                all_differential_trails.append(find_optimal_differential_trails(diff_dist_table, r))
+    else:
+        # The greedy search finds the trails of all rounds at once
+        with time_stage('trail search (all rounds)'):
+            all_differential_trails = find_highly_probable_differential_trails_for_all_rounds(diff_dist_table, 3)
+
+    for path, differential_trails in zip(paths, all_differential_trails):
+        save_cached_records(path, TRAIL_RECORD_FORMAT, differential_trails)
+
+    return all_differential_trails
+
+def get_cache_path(cache_dir, name, round_num):
+    """
+    Cached files are named after a hash of everything they depend on, so a
+    file is never used after SBOX or PBOX change. Returns None if cache_dir
+    is None.
+    """
+
+    if cache_dir is None: return None
+
+    key = repr((CACHE_VERSION, name, SBOX, PBOX, round_num)).encode()
+
+    return os.path.join(cache_dir, f'{name}-{round_num}-{hashlib.sha256(key).hexdigest()[:16]}.bin')
+
+def load_cached_records(path, record_format):
+    """
+    Reads the cached file at path and unpacks its records. Returns a list
+    of tuples, or None if there is no valid cached file.
+    """
+
+    if path is None or not os.path.isfile(path): return None
+
+    size = os.path.getsize(path)
+
+    # Probably a partially written file. It will be overwritten
+    if size % struct.calcsize(record_format) != 0: return None
+
+    if size == 0: return []
+
+    with open(path, 'rb') as f:
+        return list(struct.iter_unpack(record_format, f.read()))
+
+def save_cached_records(path, record_format, records):
+    """
+    Packs records into the cached file at path. The file is written under
+    a temporary name first, so a crash never leaves a broken cached file.
+    """
+
+    if path is None: return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temporary_path = path + '.tmp'
+
+    with open(temporary_path, 'wb') as f:
+        for record in records:
+            f.write(struct.pack(record_format, *record))
+
+    os.replace(temporary_path, path)
+
+
+
+""" --- SPN CIPHER IMPLEMENTATION --- """
+
+def encrypt(state, key1, key2, key3, key4, key5):
+    state = add_round_key(state, key1)
+    state = substitute(state, SBOX)
+    state = permutate(state, PBOX)
+
+    state = add_round_key(state, key2)
+    state = substitute(state, SBOX)
+    state = permutate(state, PBOX)
+
+    state = add_round_key(state, key3)
+    state = substitute(state, SBOX)
+    state = permutate(state, PBOX)
+
+    state = add_round_key(state, key4)
+    state = substitute(state, SBOX)
+
+    state = add_round_key(state, key5)
+
+    return state
+
+def decrypt(state, key1, key2, key3, key4, key5):
+    state = add_round_key(state, key5)
+
+    state = substitute(state, INV_SBOX)
+    state = add_round_key(state, key4)
+
+    state = permutate(state, INV_PBOX)
+    state = substitute(state, INV_SBOX)
+    state = add_round_key(state, key3)
+
+    state = permutate(state, INV_PBOX)
+    state = substitute(state, INV_SBOX)
+    state = add_round_key(state, key2)
+
+    state = permutate(state, INV_PBOX)
+    state = substitute(state, INV_SBOX)
+    state = add_round_key(state, key1)
+
+    return state
 
 def add_round_key(state, key):
     state ^= key
@@ -579,6 +2828,385 @@ def permutate(state, pbox):
 
 
 
+""" --- COMPILED CIPHER --- """
+
+def compile_cipher():
+    """
+    Precomputes full 16-bit state lookup tables from SBOX and PBOX so that a
+    whole round of the cipher becomes a single list lookup instead of the
+    nibble-by-nibble and bit-by-bit loops of substitute() and permutate().
+
+    The tables are built from the reference functions themselves, so the
+    compiled cipher is always defined by the same SBOX and PBOX:
+
+    SUB_TABLE[x]       = substitute(x, SBOX)
+    INV_SUB_TABLE[x]   = substitute(x, INV_SBOX)
+    ROUND_TABLE[x]     = permutate(substitute(x, SBOX), PBOX)
+    INV_ROUND_TABLE[x] = substitute(permutate(x, INV_PBOX), INV_SBOX)
+    """
+
+    global SUB_TABLE, INV_SUB_TABLE, ROUND_TABLE, INV_ROUND_TABLE, INV_PERM_TABLE
+    global SUB_ARRAY, INV_SUB_ARRAY, ROUND_ARRAY, INV_ROUND_ARRAY
+    global PERM_ARRAY, INV_PERM_ARRAY, INV_SBOX_DIFF_ARRAY
+
+    # Both layers work independently on each byte of the state, so we only
+    # need to call the reference functions 256 times per table. Substitution
+    # maps a zero nibble to SBOX[0], so keep only the low byte of the result
+    sub_byte = [substitute(b, SBOX) & 0xff for b in range(256)]
+    inv_sub_byte = [substitute(b, INV_SBOX) & 0xff for b in range(256)]
+
+    # Permutation is linear, so the permutation of a state is the OR of the
+    # permutations of its low and high bytes
+    perm_lo = [permutate(b, PBOX) for b in range(256)]
+    perm_hi = [permutate(b << 8, PBOX) for b in range(256)]
+    inv_perm_lo = [permutate(b, INV_PBOX) for b in range(256)]
+    inv_perm_hi = [permutate(b << 8, INV_PBOX) for b in range(256)]
+
+    SUB_TABLE = [sub_byte[x & 0xff] | (sub_byte[x >> 8] << 8) for x in range(0x10000)]
+    INV_SUB_TABLE = [inv_sub_byte[x & 0xff] | (inv_sub_byte[x >> 8] << 8) for x in range(0x10000)]
+
+    INV_PERM_TABLE = [inv_perm_lo[x & 0xff] | inv_perm_hi[x >> 8] for x in range(0x10000)]
+
+    ROUND_TABLE = [perm_lo[s & 0xff] | perm_hi[s >> 8] for s in SUB_TABLE]
+    INV_ROUND_TABLE = [INV_SUB_TABLE[x] for x in INV_PERM_TABLE]
+
+    if np is not None:
+        SUB_ARRAY = np.array(SUB_TABLE, dtype=np.uint16)
+        INV_SUB_ARRAY = np.array(INV_SUB_TABLE, dtype=np.uint16)
+        ROUND_ARRAY = np.array(ROUND_TABLE, dtype=np.uint16)
+        INV_ROUND_ARRAY = np.array(INV_ROUND_TABLE, dtype=np.uint16)
+        PERM_ARRAY = np.array([perm_lo[x & 0xff] | perm_hi[x >> 8] for x in range(0x10000)], dtype=np.uint16)
+        INV_PERM_ARRAY = np.array(INV_PERM_TABLE, dtype=np.uint16)
+
+        nibbles = np.arange(16)
+        inv_sbox = np.array(INV_SBOX, dtype=np.uint8)
+        decrypted = inv_sbox[nibbles[:, None] ^ nibbles[None, :]] # decrypted[u][g] = INV_SBOX[u ^ g]
+        INV_SBOX_DIFF_ARRAY = decrypted[:, None, :] ^ decrypted[None, :, :]
+
+def check_compiled_cipher(num_checks=256):
+    """
+    Cross-checks the compiled cipher against the reference implementation
+    on random states and keys. Returns True if they agree, False otherwise.
+    """
+
+    for i in range(num_checks):
+        state = choose_random_plaintext()
+        keys = [choose_random_plaintext() for k in range(5)]
+
+        ciphertext = encrypt(state, *keys)
+
+        if fast_encrypt(state, *keys) != ciphertext:
+            return False
+
+        if fast_decrypt(ciphertext, *keys) != decrypt(ciphertext, *keys):
+            return False
+
+        other_ciphertext = choose_random_plaintext()
+
+        for round_num in range(4):
+            reference_xor = partial_decryption(round_num, ciphertext, other_ciphertext, keys)
+            compiled_xor = fast_partial_decryption(round_num, ciphertext, other_ciphertext, keys)
+
+            if reference_xor != compiled_xor:
+                return False
+
+        if np is not None:
+            states = np.array([state], dtype=np.uint16)
+
+            if int(encrypt_batch(states, *keys)[0]) != ciphertext:
+                return False
+
+            if int(decrypt_batch(encrypt_batch(states, *keys), *keys)[0]) != state:
+                return False
+
+    # The bitsliced cipher encrypts all the checked states at once
+    states = [choose_random_plaintext() for i in range(num_checks)]
+    keys = [choose_random_plaintext() for k in range(5)]
+
+    ciphertexts = [fast_encrypt(state, *keys) for state in states]
+
+    if [int(c) for c in encrypt_bitsliced(states, *keys)] != ciphertexts:
+        return False
+
+    if [int(p) for p in decrypt_bitsliced(ciphertexts, *keys)] != states:
+        return False
+
+    return True
+
+def fast_encrypt(state, key1, key2, key3, key4, key5):
+    state = ROUND_TABLE[state ^ key1]
+    state = ROUND_TABLE[state ^ key2]
+    state = ROUND_TABLE[state ^ key3]
+    state = SUB_TABLE[state ^ key4]
+
+    return state ^ key5
+
+def fast_decrypt(state, key1, key2, key3, key4, key5):
+    state = INV_SUB_TABLE[state ^ key5]
+    state = INV_ROUND_TABLE[state ^ key4]
+    state = INV_ROUND_TABLE[state ^ key3]
+    state = INV_ROUND_TABLE[state ^ key2]
+
+    return state ^ key1
+
+def fast_partial_decryption(round_num, ciphertext1, ciphertext2, round_keys):
+    """
+    Same as partial_decryption but uses the compiled cipher tables.
+    """
+
+    for i in range(4, round_num, -1):
+        if i < 4:
+            ciphertext1 = INV_ROUND_TABLE[ciphertext1 ^ round_keys[i]]
+            ciphertext2 = INV_ROUND_TABLE[ciphertext2 ^ round_keys[i]]
+        else:
+            ciphertext1 = INV_SUB_TABLE[ciphertext1 ^ round_keys[i]]
+            ciphertext2 = INV_SUB_TABLE[ciphertext2 ^ round_keys[i]]
+
+    return ciphertext1 ^ ciphertext2
+
+
+
+""" --- BATCHED CIPHER --- """
+
+def encrypt_batch(states, key1, key2, key3, key4, key5):
+    """
+    Same as fast_encrypt but for a whole uint16 NumPy array of states at
+    once. Returns the array of ciphertexts.
+    """
+
+    states = ROUND_ARRAY[states ^ key1]
+    states = ROUND_ARRAY[states ^ key2]
+    states = ROUND_ARRAY[states ^ key3]
+    states = SUB_ARRAY[states ^ key4]
+
+    return states ^ key5
+
+def decrypt_batch(states, key1, key2, key3, key4, key5):
+    """
+    Same as fast_decrypt but for a whole uint16 NumPy array of states at
+    once. Returns the array of plaintexts.
+    """
+
+    states = INV_SUB_ARRAY[states ^ key5]
+    states = INV_ROUND_ARRAY[states ^ key4]
+    states = INV_ROUND_ARRAY[states ^ key3]
+    states = INV_ROUND_ARRAY[states ^ key2]
+
+    return states ^ key1
+
+
+
+""" --- BITSLICED CIPHER --- """
+
+# In the bitsliced cipher, a batch of states is stored as 16 "wires". Wire j
+# holds bit j of every state in the batch, so each operation on a wire works
+# on all states at once. A wire is a Python int with one bit per state, or
+# with NumPy a uint64 array with 64 states per element.
+
+def encrypt_bitsliced(states, key1, key2, key3, key4, key5):
+    """
+    Same as encrypt but for a whole batch of states at once, using the
+    bitsliced cipher. Takes a uint16 NumPy array (or a list without NumPy)
+    and returns the ciphertexts in the same form.
+    """
+
+    wires, ones = bitslice(states)
+
+    wires = bitsliced_encrypt(wires, ones, key1, key2, key3, key4, key5)
+
+    return unbitslice(wires, len(states))
+
+def decrypt_bitsliced(states, key1, key2, key3, key4, key5):
+    """
+    Same as decrypt but for a whole batch of states at once, using the
+    bitsliced cipher. Takes a uint16 NumPy array (or a list without NumPy)
+    and returns the plaintexts in the same form.
+    """
+
+    wires, ones = bitslice(states)
+
+    wires = bitsliced_decrypt(wires, ones, key1, key2, key3, key4, key5)
+
+    return unbitslice(wires, len(states))
+
+def bitsliced_encrypt(wires, ones, key1, key2, key3, key4, key5):
+    sbox_circuit = build_sbox_circuit(SBOX)
+
+    wires = bitsliced_add_round_key(wires, ones, key1)
+    wires = bitsliced_substitute(wires, ones, sbox_circuit)
+    wires = bitsliced_permutate(wires, PBOX)
+
+    wires = bitsliced_add_round_key(wires, ones, key2)
+    wires = bitsliced_substitute(wires, ones, sbox_circuit)
+    wires = bitsliced_permutate(wires, PBOX)
+
+    wires = bitsliced_add_round_key(wires, ones, key3)
+    wires = bitsliced_substitute(wires, ones, sbox_circuit)
+    wires = bitsliced_permutate(wires, PBOX)
+
+    wires = bitsliced_add_round_key(wires, ones, key4)
+    wires = bitsliced_substitute(wires, ones, sbox_circuit)
+
+    wires = bitsliced_add_round_key(wires, ones, key5)
+
+    return wires
+
+def bitsliced_decrypt(wires, ones, key1, key2, key3, key4, key5):
+    inv_sbox_circuit = build_sbox_circuit(INV_SBOX)
+
+    wires = bitsliced_add_round_key(wires, ones, key5)
+
+    wires = bitsliced_substitute(wires, ones, inv_sbox_circuit)
+    wires = bitsliced_add_round_key(wires, ones, key4)
+
+    wires = bitsliced_permutate(wires, INV_PBOX)
+    wires = bitsliced_substitute(wires, ones, inv_sbox_circuit)
+    wires = bitsliced_add_round_key(wires, ones, key3)
+
+    wires = bitsliced_permutate(wires, INV_PBOX)
+    wires = bitsliced_substitute(wires, ones, inv_sbox_circuit)
+    wires = bitsliced_add_round_key(wires, ones, key2)
+
+    wires = bitsliced_permutate(wires, INV_PBOX)
+    wires = bitsliced_substitute(wires, ones, inv_sbox_circuit)
+    wires = bitsliced_add_round_key(wires, ones, key1)
+
+    return wires
+
+def bitsliced_add_round_key(wires, ones, key):
+    """
+    Every state gets the same key, so a key bit of 1 flips the whole wire.
+    """
+
+    return [wires[i] ^ ones if get_bit(key, i) == 1 else wires[i] for i in range(16)]
+
+def bitsliced_substitute(wires, ones, sbox_circuit):
+    """
+    Evaluates the boolean circuit of the SBOX (see build_sbox_circuit) on
+    the 4 wires of every nibble.
+    """
+
+    new_wires = []
+
+    for i in range(4):
+        inputs = wires[4 * i:4 * i + 4]
+
+        # products[m] is the AND of the input wires whose bits are set in m.
+        # Each one is the product of a smaller one and a single input wire
+        products = [ones]
+
+        for m in range(1, 16):
+            lowest = (m & -m).bit_length() - 1
+
+            products.append(products[m & (m - 1)] & inputs[lowest])
+
+        for monomials in sbox_circuit:
+            output = 0 if np is None else np.zeros_like(ones)
+
+            for m in monomials:
+                output = output ^ products[m]
+
+            new_wires.append(output)
+
+    return new_wires
+
+def bitsliced_permutate(wires, pbox):
+    """
+    Permutating bits of the states is just reordering the wires.
+    """
+
+    return [wires[pbox[i]] for i in range(16)]
+
+def build_sbox_circuit(sbox):
+    """
+    Derives a boolean circuit for sbox from its list. Every output bit is
+    written in algebraic normal form: an XOR of ANDs (monomials) of input
+    bits. Each monomial is given as a 4-bit mask of the input bits it ANDs,
+    with 0 being the constant 1.
+
+    Returns a list with the monomials of every output bit, least significant
+    bit first.
+    """
+
+    sbox_circuit = []
+
+    for output_bit in range(4):
+        # The Moebius transform turns the truth table into the coefficients
+        # of the algebraic normal form
+        anf = [get_bit(sbox[x], output_bit) for x in range(16)]
+
+        for i in range(4):
+            for x in range(16):
+                if get_bit(x, i) == 1:
+                    anf[x] ^= anf[x ^ (1 << i)]
+
+        sbox_circuit.append([m for m in range(16) if anf[m] == 1])
+
+    return sbox_circuit
+
+def bitslice(states):
+    """
+    Transposes a batch of states into 16 wires. Returns the wires and a wire
+    with all bits set (used for key addition and constants) in this form:
+
+    (wires, ones)
+    """
+
+    if np is not None:
+        states = np.asarray(states, dtype=np.uint16)
+
+        # Pad to a whole number of 64 bit words
+        num_words = max(1, math.ceil(len(states) / 64))
+
+        bits = np.zeros((16, num_words * 64), dtype=np.uint8)
+
+        for j in range(16):
+            bits[j, :len(states)] = (states >> j) & 1
+
+        wires = np.packbits(bits, axis=1, bitorder='little').view('<u8')
+
+        return (list(wires), np.full(num_words, 0xffffffffffffffff, dtype=np.uint64))
+
+    # Build each wire from a string of its bits, the last state first since
+    # it ends up as the most significant bit
+    wires = []
+
+    for j in range(16):
+        wire_string = ''.join('1' if (state >> j) & 1 else '0' for state in reversed(states))
+
+        wires.append(int(wire_string, 2) if wire_string else 0)
+
+    return (wires, (1 << len(states)) - 1)
+
+def unbitslice(wires, num_states):
+    """
+    Transposes 16 wires back into num_states states. The inverse of bitslice
+    """
+
+    if np is not None:
+        bits = np.unpackbits(np.array(wires, dtype='<u8').view(np.uint8), axis=1, bitorder='little')
+
+        states = np.zeros(num_states, dtype=np.uint16)
+
+        for j in range(16):
+            states |= bits[j, :num_states].astype(np.uint16) << j
+
+        return states
+
+    states = [0] * num_states
+
+    for j in range(16):
+        # Bits of the wire as a string, the first state first
+        wire_string = format(wires[j], f'0{num_states}b')[::-1] if num_states else ''
+
+        for k in range(num_states):
+            if wire_string[k] == '1':
+                states[k] |= 1 << j
+
+    return states
+
+
+
 """ --- BIT STRING FUNCTIONS --- """
 
 def count_one_bits(bit_string):
@@ -595,6 +3223,42 @@ def count_one_bits(bit_string):
 
     return count
 
+def find_xor_basis(bit_strings):
+    """
+    Returns a basis of the span of bit_strings under XOR, where every basis
+    vector has a different highest 1 bit, which no other basis vector has.
+    """
+
+    basis = []
+
+    for bit_string in bit_strings:
+        bit_string = reduce_by_xor_basis(bit_string, basis)
+
+        if bit_string == 0: continue # Already in the span
+
+        # Keep the highest bit of the new vector out of the other vectors
+        highest = 1 << (bit_string.bit_length() - 1)
+
+        basis = [v ^ bit_string if v & highest else v for v in basis]
+        basis.append(bit_string)
+
+    return basis
+
+def reduce_by_xor_basis(bit_string, basis):
+    """
+    Clears the highest bit of every basis vector (see find_xor_basis) from
+    bit_string by XORing with it. The result is zero if and only if
+    bit_string is in the span of the basis.
+    """
+
+    for vector in basis:
+        highest = 1 << (vector.bit_length() - 1)
+
+        if bit_string & highest:
+            bit_string ^= vector
+
+    return bit_string
+
 def get_bit(bit_string, index):
     """
     Returns the index-th bit in bit_string
@@ -663,8 +3327,222 @@ def set_nibble(bit_string, index, value):
 
 
 
+""" --- INSTRUMENTATION --- """
+
+@contextlib.contextmanager
+def time_stage(name):
+    """
+    Times the code inside the with statement as the stage name. Stages
+    which run more than once (like breaking a round key while backtracking)
+    add up.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_stage_time(name, time.perf_counter() - start)
+
+def record_stage_time(name, seconds):
+    stage = STAGE_TIMES.setdefault(name, {'calls': 0, 'seconds': 0.0})
+
+    stage['calls'] += 1
+    stage['seconds'] += seconds
+
+def record_key_guess_stats(num_pairs, num_counted, num_bins, breaking_key_bits):
+    """
+    Records the work done by break_key_bits on num_pairs ciphertext pairs,
+    num_counted of which survived filter_right_pair_candidates and were
+    compressed into num_bins histogram bins by compress_pairs.
+
+    Every bin is checked against every key guess. The partial decryptions
+    are counted by partially_decrypt_known_rounds itself.
+    """
+
+    num_key_guesses = num_bins << count_one_bits(breaking_key_bits)
+
+    ATTACK_STATS['pairs_processed'] += num_pairs
+    ATTACK_STATS['pairs_counted'] += num_counted
+    ATTACK_STATS['histogram_bins'] += num_bins
+    ATTACK_STATS['key_guesses'] += num_key_guesses
+
+def reset_attack():
+    """
+    Forgets everything recorded about previous attacks and everything they
+    collected (chosen pairs, plaintext structures and round key
+    candidates), so that another attack, maybe with other keys, can be run
+    and measured in the same process.
+    """
+
+    for kind in ('encrypt', 'decrypt'):
+        ORACLE_QUERIES[kind] = 0
+        ORACLE_SEEN[kind][:] = bytes(0x10000)
+
+    for stats in (PAIR_FILTER_STATS, STRUCTURE_STATS, ADAPTIVE_STATS, ATTACK_STATS):
+        for name in stats:
+            stats[name] = 0
+
+    STRUCTURES.clear()
+    PER_TRAIL_PAIRS.clear()
+    CHOSEN_PAIRS.clear()
+    ADAPTIVE_ROUND_TRIPS.clear()
+    ROUND_KEY_CACHE.clear()
+    KNOWN_PAIRS.clear()
+    STAGE_TIMES.clear()
+
+    get_oracle().round_trips = 0
+
+def get_peak_memory():
+    """
+    Returns the peak resident memory of this process in bytes, or None if
+    it can't be found out on this platform.
+    """
+
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Bytes on macOS, kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return max_rss
+
+    return max_rss * 1024
+
+def get_report(args, round_keys, total_seconds):
+    """
+    Returns everything measured during the attack as a dictionary which can
+    be dumped as JSON. round_keys is None if the attack failed.
+    """
+
+    oracle = get_oracle()
+
+    oracle_report = {
+        'encrypt': ORACLE_QUERIES['encrypt'],
+        'decrypt': ORACLE_QUERIES['decrypt'],
+        'distinct_encrypt': sum(ORACLE_SEEN['encrypt']),
+        'distinct_decrypt': sum(ORACLE_SEEN['decrypt']),
+        'round_trips': oracle.round_trips,
+    }
+
+    if isinstance(oracle, SocketOracle):
+        oracle_report['requests'] = oracle.requests
+
+    report = {
+        'config': {
+            'sbox': SBOX,
+            'pbox': PBOX,
+            'c': C,
+            'min_options': MIN_OPTIONS,
+            'numpy': np is not None,
+            'arguments': vars(args),
+        },
+        'success': round_keys is not None,
+        'round_keys': None if round_keys is None else [format(k, '#06x') for k in round_keys],
+        'oracle_queries': oracle_report,
+        'attack': dict(ATTACK_STATS),
+        'pair_filter': dict(PAIR_FILTER_STATS),
+        'stages': {name: dict(stage) for name, stage in STAGE_TIMES.items()},
+        'total_seconds': total_seconds,
+        'peak_memory_bytes': get_peak_memory(),
+    }
+
+    if args.structures:
+        report['structures'] = dict(STRUCTURE_STATS)
+
+    if args.adaptive:
+        report['adaptive_sampling'] = dict(ADAPTIVE_STATS)
+
+    return report
+
+def write_report(path, args, round_keys, total_seconds):
+    """
+    Writes the JSON report from get_report to path, or to standard output
+    if path is '-'.
+    """
+
+    report = json.dumps(get_report(args, round_keys, total_seconds), indent=2)
+
+    if path == '-':
+        print(report)
+
+        return
+
+    with open(path, 'w') as f:
+        f.write(report + '\n')
+
+
+
 """ --- MISC FUNCTIONS --- """
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Differential cryptanalysis of a basic SPN cipher.')
+
+    parser.add_argument('--codebook', action='store_true',
+                        help='materialize the full codebook once and answer all oracle queries from it')
+    parser.add_argument('--workers', type=int, default=1,
+                        help=f'number of processes used to count key guesses. Only counts of at least {PARALLEL_MIN_KEY_GUESSES} key guesses '
+                             '(histogram bins times 2^bits) are split between them, smaller ones are faster in one process (default: 1)')
+    parser.add_argument('--trail-search', choices=['optimal', 'greedy'], default='optimal',
+                        help='find the most probable trail for every combination of final active SBOXes with branch-and-bound, '
+                             'or a greedy trail for every input XOR (default: optimal)')
+    parser.add_argument('--structures', action='store_true',
+                        help='choose plaintext structures shared by all trails of a round instead of separate pairs for every trail')
+    parser.add_argument('--ddt-filter', action='store_true',
+                        help='also filter out pairs whose active SBOX XORs are impossible according to the difference distribution table')
+    parser.add_argument('--oracle-backend', choices=['table', 'bitsliced'], default='table',
+                        help='how the oracle encrypts chosen plaintexts when there is no codebook (default: table)')
+    parser.add_argument('--serve-oracle', metavar='ADDRESS',
+                        help='instead of attacking, serve the oracle on ADDRESS (tcp:HOST:PORT or unix:PATH)')
+    parser.add_argument('--oracle', metavar='ADDRESS',
+                        help='send oracle queries to the oracle server on ADDRESS instead of answering them in this process')
+    parser.add_argument('--cache-dir',
+                        help='directory in which the trail tables are cached between runs')
+    parser.add_argument('--exact-probabilities', action='store_true',
+                        help='size the number of chosen plaintexts by the exact differential probability of each trail '
+                             'instead of the probability of the single trail')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='choose the pairs of the trails of every round key in steps, one oracle round trip for all of them per step, '
+                             'and stop a trail as soon as none of the key guesses it throws away can be the right one, '
+                             'instead of always choosing C / probability pairs')
+    parser.add_argument('--error-bound', type=float, default=0.01,
+                        help='with --adaptive, the tolerated probability of throwing away the right key guess of a trail, '
+                             'over all of its steps together (default: 0.01)')
+    parser.add_argument('--chunk-size', type=int, default=PAIR_CHUNK_SIZE,
+                        help=f'number of chosen pairs encrypted, filtered and counted at a time, which bounds memory (default: {PAIR_CHUNK_SIZE})')
+    parser.add_argument('--progress', action='store_true',
+                        help='report the progress of trails which need more than one chunk of pairs on standard error')
+    parser.add_argument('--report', metavar='PATH',
+                        help='write a JSON report of oracle queries, key guesses, time per stage and peak memory to PATH '
+                             '(- for standard output, which moves everything else to standard error)')
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error('--workers should be at least 1')
+
+    if not 0 < args.error_bound < 1:
+        parser.error('--error-bound should be between 0 and 1')
+
+    if args.chunk_size < 1:
+        parser.error('--chunk-size should be at least 1')
+
+    if args.adaptive and args.structures:
+        parser.error('--adaptive can\'t be combined with --structures, whose pairs are chosen for all trails at once')
+
+    for address in (args.serve_oracle, args.oracle):
+        if address is not None:
+            try:
+                parse_oracle_address(address)
+            except ValueError as e:
+                parser.error(str(e))
+
+    if args.oracle is not None and (args.codebook or args.oracle_backend != 'table'):
+        parser.error('--codebook and --oracle-backend only apply to an oracle in this process (or with --serve-oracle)')
+
+    return args
+
 def validate_input():
     if len(SBOX) != 16:
         sys.exit('Error: SBOX list should have 16 elements')
@@ -0,0 +1,302 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import statistics
+import contextlib
+import importlib.util
+import concurrent.futures
+
+"""
+Runs the full SPN attack of spn-diff-crypt.py many times with random keys,
+for several values of C (and MIN_OPTIONS), to find out how reliably the
+attack succeeds and how much it costs with each of them.
+
+Every trial gets its own keys and seed, both derived from --seed, and the
+same trial number gets the same keys for every value of C, so that the
+curves are compared on the same keys. The trials run in a process pool. """
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The attack script loaded in every worker process, and the trails it uses
+# to break each round key (the same for every trial, so they're only found
+# once)
+SPN = None
+USEFUL_DIFF_TRAILS = None
+USE_STRUCTURES = False
+
+def main():
+    args = parse_arguments()
+
+    spn = load_spn_script()
+
+    print('Finding differential trails... ', end='', flush=True)
+    useful_diff_trails = find_useful_diff_trails(spn, args.trail_search, args.cache_dir)
+    print('FOUND')
+
+    tasks = [(c, min_options, args.seed, trial) for c in args.c for min_options in args.min_options for trial in range(args.trials)]
+
+    print(f'Running {len(tasks)} attacks with {args.workers} workers...\n', flush=True)
+
+    start = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=start_worker, initargs=(useful_diff_trails, args.structures, args.error_bound if args.adaptive else None)) as pool:
+        trials = list(pool.map(run_trial, tasks, chunksize=max(1, len(tasks) // (4 * args.workers))))
+
+    end = time.time()
+
+    curves = get_curves(trials, args.c, args.min_options)
+
+    print(get_curves_string(curves))
+    print(f'\nRan {len(trials)} attacks in {round(end - start, 2)} seconds')
+
+    if args.json is not None:
+        write_results(args.json, args, spn, curves, trials)
+
+
+
+""" --- TRIALS --- """
+
+def start_worker(useful_diff_trails, use_structures, adaptive_error_bound):
+    global SPN, USEFUL_DIFF_TRAILS, USE_STRUCTURES
+
+    SPN = load_spn_script()
+    SPN.compile_cipher()
+
+    if adaptive_error_bound is not None:
+        SPN.use_adaptive_sampling(adaptive_error_bound)
+
+    USEFUL_DIFF_TRAILS = useful_diff_trails
+    USE_STRUCTURES = use_structures
+
+def run_trial(task):
+    """
+    Runs one full attack with the keys and seed of the given trial and
+    returns what it cost and whether it found the right keys.
+    """
+
+    c, min_options, seed, trial = task
+
+    keys = get_trial_keys(seed, trial)
+
+    SPN.KEY1, SPN.KEY2, SPN.KEY3, SPN.KEY4, SPN.KEY5 = keys
+    SPN.C = c
+    SPN.MIN_OPTIONS = min_options
+
+    SPN.reset_attack()
+
+    random.seed(f'{seed}:{trial}:{c}:{min_options}')
+
+    start = time.perf_counter()
+
+    # The attack explains everything it does. Nobody reads that for
+    # hundreds of attacks
+    with contextlib.redirect_stdout(io.StringIO()):
+        round_keys = SPN.break_all_round_keys(*USEFUL_DIFF_TRAILS, USE_STRUCTURES)
+
+    end = time.perf_counter()
+
+    return {
+        'c': c,
+        'min_options': min_options,
+        'trial': trial,
+        'keys': [format(k, '#06x') for k in keys],
+        # Confirmation only checks that the keys encrypt like the real ones,
+        # so with some SBOXes equivalent keys can be found instead
+        'success': round_keys is not None,
+        'exact': round_keys == keys,
+        'encrypt_queries': SPN.ORACLE_QUERIES['encrypt'],
+        'distinct_encrypt_queries': sum(SPN.ORACLE_SEEN['encrypt']),
+        'round_keys_broken': SPN.ATTACK_STATS['round_keys_broken'],
+        'confirmations': SPN.ATTACK_STATS['confirmations'],
+        'key_guesses': SPN.ATTACK_STATS['key_guesses'],
+        'seconds': end - start,
+    }
+
+def get_trial_keys(seed, trial):
+    rng = random.Random(f'{seed}:{trial}')
+
+    return [rng.getrandbits(16) for i in range(5)]
+
+def find_useful_diff_trails(spn, trail_search, cache_dir):
+    """
+    Finds the trails used to break KEY5, KEY4, KEY3 and KEY2, in that order,
+    the same way spn-diff-crypt.py does.
+    """
+
+    spn.validate_input()
+    spn.compile_cipher()
+
+    diff_dist_table = spn.build_difference_distribution_table(spn.SBOX)
+    most_probable_diff_trails = spn.get_differential_trails(diff_dist_table, trail_search, cache_dir)
+
+    return [spn.find_differential_trails_to_break_full_key(r, most_probable_diff_trails[r]) for r in (3, 2, 1, 0)]
+
+
+
+""" --- STATISTICS --- """
+
+def get_curves(trials, c_values, min_options_values):
+    """
+    Summarizes the trials of every combination of C and MIN_OPTIONS: the
+    success rate (with a 95% Wilson interval) and the cost of the attack.
+    Costs are averaged over all trials, failed ones included, since they
+    cost just as much.
+    """
+
+    curves = []
+
+    for min_options in min_options_values:
+        for c in c_values:
+            group = [t for t in trials if t['c'] == c and t['min_options'] == min_options]
+
+            successes = sum(t['success'] for t in group)
+            low, high = get_wilson_interval(successes, len(group))
+
+            curves.append({
+                'c': c,
+                'min_options': min_options,
+                'trials': len(group),
+                'successes': successes,
+                'success_rate': successes / len(group),
+                'success_rate_low': low,
+                'success_rate_high': high,
+                'mean_encrypt_queries': statistics.mean(t['encrypt_queries'] for t in group),
+                'median_encrypt_queries': statistics.median(t['encrypt_queries'] for t in group),
+                'mean_round_keys_broken': statistics.mean(t['round_keys_broken'] for t in group),
+                'mean_confirmations': statistics.mean(t['confirmations'] for t in group),
+                'mean_seconds': statistics.mean(t['seconds'] for t in group),
+            })
+
+    return curves
+
+def get_wilson_interval(successes, trials, z=1.96):
+    """
+    Returns the Wilson score interval for a success probability. Unlike
+    the usual normal approximation, it stays sensible for success rates
+    close to 0 or 1, which is exactly where we're looking.
+    """
+
+    if trials == 0: return (0.0, 1.0)
+
+    p = successes / trials
+
+    center = (p + z * z / (2 * trials)) / (1 + z * z / trials)
+    margin = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / (1 + z * z / trials)
+
+    return (max(0.0, center - margin), min(1.0, center + margin))
+
+def get_curves_string(curves):
+    string = f'{"C":>8} {"MIN_OPTIONS":>11} {"success":>8} {"95% interval":>15} {"queries":>9} {"round keys":>10} {"confirms":>8} {"seconds":>8}\n'
+
+    for curve in curves:
+        interval = f'[{curve["success_rate_low"]:.2f}, {curve["success_rate_high"]:.2f}]'
+
+        string += f'{curve["c"]:>8g} {curve["min_options"]:>11} {curve["success_rate"]:>8.2f} {interval:>15} ' \
+                  f'{curve["mean_encrypt_queries"]:>9.0f} {curve["mean_round_keys_broken"]:>10.2f} ' \
+                  f'{curve["mean_confirmations"]:>8.2f} {curve["mean_seconds"]:>8.3f}\n'
+
+    # Remove last newline
+    return string[:-1]
+
+def write_results(path, args, spn, curves, trials):
+    """
+    Writes the curves and every trial as JSON to path, or to standard
+    output if path is '-'.
+    """
+
+    results = {
+        'sbox': spn.SBOX,
+        'pbox': spn.PBOX,
+        'seed': args.seed,
+        'trail_search': args.trail_search,
+        'structures': args.structures,
+        'adaptive_error_bound': args.error_bound if args.adaptive else None,
+        'curves': curves,
+        'trials': trials,
+    }
+
+    results = json.dumps(results, indent=2)
+
+    if path == '-':
+        print('\n' + results)
+
+        return
+
+    with open(path, 'w') as f:
+        f.write(results + '\n')
+
+
+
+""" --- MISC FUNCTIONS --- """
+
+def load_spn_script():
+    """
+    spn-diff-crypt.py has dashes in its name, so it can't simply be
+    imported.
+    """
+
+    spec = importlib.util.spec_from_file_location('spn_diff_crypt', os.path.join(SCRIPT_DIR, 'spn-diff-crypt.py'))
+    module = importlib.util.module_from_spec(spec)
+
+    sys.modules['spn_diff_crypt'] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Success rate and cost of the SPN attack as a function of C.')
+
+    parser.add_argument('-c', type=float, nargs='+', default=[5, 10, 15, 20, 30, 40],
+                        help='values of C to try (default: 5 10 15 20 30 40)')
+    parser.add_argument('--min-options', type=int, nargs='+', default=[3],
+                        help='values of MIN_OPTIONS to try (default: 3)')
+    parser.add_argument('--trials', type=int, default=100,
+                        help='number of attacks for every combination of C and MIN_OPTIONS (default: 100)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of processes running attacks (default: number of CPUs)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed from which the keys and the chosen plaintexts of every trial are derived (default: 0)')
+    parser.add_argument('--trail-search', choices=['optimal', 'greedy'], default='optimal',
+                        help='how the differential trails are found, see spn-diff-crypt.py (default: optimal)')
+    parser.add_argument('--structures', action='store_true',
+                        help='attack with plaintext structures, see spn-diff-crypt.py')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='attack with adaptive sampling, see spn-diff-crypt.py')
+    parser.add_argument('--error-bound', type=float, default=0.01,
+                        help='probability of adaptive sampling throwing away the right key guess of a trail, see spn-diff-crypt.py (default: 0.01)')
+    parser.add_argument('--cache-dir',
+                        help='directory in which the trail tables are cached between runs')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the curves and every trial as JSON to PATH (- for standard output)')
+
+    args = parser.parse_args()
+
+    if not 0 < args.error_bound < 1:
+        parser.error('--error-bound should be between 0 and 1')
+
+    if args.adaptive and args.structures:
+        parser.error('--adaptive can\'t be combined with --structures')
+
+    if args.trials < 1:
+        parser.error('--trials should be at least 1')
+
+    if args.workers < 1:
+        parser.error('--workers should be at least 1')
+
+    if any(c <= 0 for c in args.c):
+        parser.error('values of C should be positive')
+
+    if any(min_options < 1 for min_options in args.min_options):
+        parser.error('values of MIN_OPTIONS should be at least 1')
+
+    return args
+
+
+
+if __name__=="__main__":
+    main()
@@ -1,6 +1,12 @@
 import sys
 import random
 
+# NumPy is optional. It is only needed for encrypt_batch and decrypt_batch
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 """
 This script was written for the Differential Cryptanalysis Tutorial.
 https://maticstric.github.io/differential-cryptanalysis-tutorial/
@@ -232,6 +238,33 @@ def decrypt(state, key1, key2):
 
     return state
 
+def encrypt_batch(states, key1, key2):
+    """
+    Same as encrypt but for a whole NumPy array of states at once. Returns
+    the array of ciphertexts.
+
+    The attack itself doesn't use it: with only 16 plaintexts, the plain
+    loop in get_good_pair is faster than going through NumPy.
+    """
+
+    states = add_round_key(states, key1)
+    states = np.asarray(SBOX, dtype=np.uint8)[states]
+    states = add_round_key(states, key2)
+
+    return states
+
+def decrypt_batch(states, key1, key2):
+    """
+    Same as decrypt but for a whole NumPy array of states at once. Returns
+    the array of plaintexts.
+    """
+
+    states = add_round_key(states, key2)
+    states = np.asarray(INV_SBOX, dtype=np.uint8)[states]
+    states = add_round_key(states, key1)
+
+    return states
+
 def substitute(state, sbox):
     return sbox[state]
 